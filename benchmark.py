@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+
+from metricsutil import ImportMetrics
+from xmlutil import XML2TreeSelect
+from sqlutil import ArrowWriter, CreateSQL, InsertSQL, SQLGlobals
+from util import XMLParser, lxml_etree
+
+
+BMECAT_NS = 'http://www.bmecat.org/bmecat/2005'
+EXT_NS = 'urn:example:bmecat-ext'
+
+
+class BMEcatGenerator:
+    # Writes a synthetic catalog in the BMEcat layout convert2sql.py reads:
+    # ARTICLE with ARTICLE_DETAILS, FEATURE, ARTICLE_PRICE, MIME and KEYWORD
+    records: int
+    depth: int
+    fanout: int
+    attributes: float
+    namespaces: bool
+    elements: int
+
+    def __init__(self,
+                 records:    int = 10000,
+                 depth:      int = 0,
+                 fanout:     int = 4,
+                 attributes: float = 0.5,
+                 namespaces: bool = False,
+                 seed:       int = 1):
+        self.records = records
+        self.depth = depth
+        self.fanout = fanout
+        self.attributes = attributes
+        self.namespaces = namespaces
+        self.random = random.Random(seed)
+        self.elements = 0
+
+    def get_attributes(self, **attributes) -> str:
+        # Every attribute is written with the probability of the attribute density
+        return ''.join(f' {name}="{escape(str(value))}"' for name, value in attributes.items()
+                       if self.random.random() < self.attributes)
+
+    def element(self, tag: str, text, attributes: str = '') -> str:
+        self.elements += 1
+        return f'<{tag}{attributes}>{escape(str(text))}</{tag}>'
+
+    def get_article(self, i: int) -> str:
+        rnd = self.random
+        out = [f'<ARTICLE{self.get_attributes(mode="new", status="core")}>',
+               self.element('SUPPLIER_AID', f'A{i:08d}'),
+               '<ARTICLE_DETAILS>',
+               self.element('DESCRIPTION_SHORT', f'Article {i} "{rnd.choice("ABCDEFGH")}"'),
+               self.element('DESCRIPTION_LONG', f"Long description of article {i}, it's synthetic " * rnd.randint(1, 4)),
+               self.element('EAN', 4000000000000 + i),
+               self.element('MANUFACTURER_AID', 100000 + i % 5000),
+               self.element('MANUFACTURER_NAME', f'Manufacturer {i % 97}'),
+               self.element('ARTICLE_ORDER', i)]
+        self.elements += 2
+
+        if self.depth:
+            out.append(''.join(f'<LEVEL_{d}{self.get_attributes(level=d)}>' for d in range(self.depth)))
+            out.append(self.element('LEAF', rnd.randint(0, 999)))
+            out.append(''.join(f'</LEVEL_{d}>' for d in reversed(range(self.depth))))
+            self.elements += self.depth
+
+        if self.namespaces:
+            out.append(self.element('ext:CLASSIFICATION', f'C{i % 31}', self.get_attributes(**{'ext:system': 'ECLASS'})))
+        out.append('</ARTICLE_DETAILS>')
+
+        out.append('<ARTICLE_FEATURES>')
+        self.elements += 1
+        for f in range(rnd.randint(0, 2 * self.fanout)):
+            out.append(f'<FEATURE{self.get_attributes(ftype="numeric")}>')
+            out.append(self.element('FNAME', f'Feature {f}'))
+            out.append(self.element('FVALUE', f'{rnd.random() * 100:.2f}'))
+            if f % 2:
+                out.append(self.element('FUNIT', rnd.choice(('mm', 'kg', 'V'))))
+            out.append('</FEATURE>')
+            self.elements += 1
+        out.append('</ARTICLE_FEATURES>')
+
+        out.append('<ARTICLE_PRICE_DETAILS>')
+        self.elements += 1
+        for p in range(rnd.randint(1, 3)):
+            out.append(f'<ARTICLE_PRICE{self.get_attributes(price_type="net_list")}>')
+            out.append(self.element('PRICE_AMOUNT', f'{rnd.randint(1, 9999) / 100:.2f}'))
+            out.append(self.element('PRICE_CURRENCY', 'EUR'))
+            out.append(self.element('TAX', '0.19'))
+            out.append(self.element('LOWER_BOUND', p * 10 + 1))
+            out.append('</ARTICLE_PRICE>')
+            self.elements += 1
+        out.append('</ARTICLE_PRICE_DETAILS>')
+
+        out.append('<MIME_INFO>')
+        self.elements += 1
+        for m in range(rnd.randint(0, 2)):
+            out.append('<MIME>')
+            out.append(self.element('MIME_TYPE', 'image/jpeg'))
+            out.append(self.element('MIME_SOURCE', f'images/{i}_{m}.jpg'))
+            out.append(self.element('MIME_PURPOSE', rnd.choice(('normal', 'thumbnail'))))
+            out.append('</MIME>')
+            self.elements += 1
+        out.append('</MIME_INFO>')
+
+        for k in range(rnd.randint(0, self.fanout)):
+            out.append(self.element('KEYWORD', f'keyword {rnd.randint(0, 500)}'))
+
+        out.append('</ARTICLE>')
+        return ''.join(out)
+
+    def write(self, path: str) -> int:
+        ns = f' xmlns="{BMECAT_NS}" xmlns:ext="{EXT_NS}"' if self.namespaces else ''
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write(f'<BMECAT version="2005"{ns}><HEADER><CATALOG>')
+            f.write('<LANGUAGE>deu</LANGUAGE><CATALOG_ID>synthetic</CATALOG_ID></CATALOG></HEADER>')
+            f.write('<T_NEW_CATALOG>\n')
+            self.elements = 6
+            for i in range(1, self.records + 1):
+                f.write(self.get_article(i))
+                f.write('\n')
+            f.write('</T_NEW_CATALOG></BMECAT>\n')
+        return self.elements
+
+
+class Benchmark:
+
+    @staticmethod
+    def get_peak_rss() -> int:
+        # Kilobytes on Linux, bytes on macOS
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    @staticmethod
+    def get_size(path: str) -> int:
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    @staticmethod
+    def analyze(source: str, elements: int) -> dict:
+        start = time.perf_counter()
+        XML2TreeSelect.convert_file(source, True)
+        seconds = time.perf_counter() - start
+        return {'seconds': round(seconds, 3), 'elements_per_s': round(elements / seconds)}
+
+    @staticmethod
+    def insert(source: str, sink: str, output: str, elements: int) -> dict:
+        struct, checked = XML2TreeSelect.convert_file(source, True)
+        statements = []
+        tables = {}
+        CreateSQL.search_checked_nodes(struct, checked, statements, False, tables)
+
+        url = {'sqlite': 'sqlite:///', 'sql': 'file:///', 'sql.gz': 'file:///', 'parquet': 'parquet:///'}[sink] + output
+        metrics = ImportMetrics(f'{sink} import', os.path.getsize(source))
+        metrics.start()
+        db = SQLGlobals(url, checked, True, False, tables=tables)
+        db.progress = metrics
+        db.begin()
+        if sink != 'parquet':
+            for stmt in statements:
+                db.run(stmt)
+        InsertSQL.stream_checked_nodes(source, db)
+        db.create_indexes()
+        db.end()
+        db.close()
+        metrics.finish()
+
+        result = metrics.get_metrics()
+        seconds = metrics.get_seconds()
+        return {'seconds': round(seconds, 3),
+                'elements_per_s': round(elements / seconds),
+                'rows_per_s': result['rows_per_s'],
+                'rows': result['rows'],
+                'times': result['times']}
+
+    @staticmethod
+    def convert2sql(source: str, output: str, elements: int) -> dict:
+        import resource
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert2sql.py')
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, source, output], check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+
+        con = sqlite3.connect(output)
+        tables = [name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        rows = sum(con.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in tables)
+        con.close()
+
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return {'seconds': round(seconds, 3),
+                'elements_per_s': round(elements / seconds),
+                'rows_per_s': round(rows / seconds),
+                'rows': rows,
+                'peak_rss': peak if sys.platform == 'darwin' else peak * 1024}
+
+    @staticmethod
+    def run_case(case: str, source: str, output: str, elements: int) -> dict:
+        # Runs in a fresh process, so the peak RSS belongs to this case alone
+        if case == 'analyze':
+            result = Benchmark.analyze(source, elements)
+        elif case == 'convert2sql':
+            return Benchmark.convert2sql(source, output, elements)
+        else:
+            result = Benchmark.insert(source, case, output, elements)
+        result['peak_rss'] = Benchmark.get_peak_rss()
+        return result
+
+    @staticmethod
+    def run(cases: list, source: str, folder: str, elements: int) -> dict:
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        for case in cases:
+            output = os.path.join(folder, f'output.{case}')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(Benchmark.run_case, case, source, output, elements).result()
+            result['output_size'] = Benchmark.get_size(output)
+            result['parser'] = XMLParser.backend
+            results[case] = result
+            print(f'{case:12} {result["seconds"]:8.2f} s {result["elements_per_s"]:10} elements/s '
+                  f'{result.get("rows_per_s", 0):9} rows/s {result["peak_rss"] >> 20:6} MB peak '
+                  f'{result["output_size"] >> 10:9} KB output')
+        return results
+
+    @staticmethod
+    def snapshot(source:  str,
+                 folder:  str,
+                 checked: list = None) -> dict:
+        # Everything the import derives from the file with the current backend: the analysis,
+        # the statements and the rows of a sequential and a parallel sqlite import. The checked
+        # paths replace the lists found by the analysis, like a selection on the page.
+        struct, found = XML2TreeSelect.convert_file(source, True)
+        checked = checked or found
+        statements = []
+        tables = {}
+        CreateSQL.search_checked_nodes(struct, checked, statements, False, tables)
+        snapshot = {'analysis': [struct, checked], 'statements': statements}
+
+        for mode in ('sequential', 'parallel'):
+            path = os.path.join(folder, f'{XMLParser.backend}.{mode}.db')
+            db = SQLGlobals(f'sqlite:///{path}', checked, True, False, tables=tables)
+            db.begin()
+            for stmt in statements:
+                db.run(stmt)
+            if mode == 'parallel':
+                InsertSQL.parallel_checked_nodes(source, db)
+            else:
+                InsertSQL.stream_checked_nodes(source, db)
+            db.end()
+            db.close()
+
+            con = sqlite3.connect(path)
+            names = [name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            snapshot[f'{mode} rows'] = {name: sorted(map(repr, con.execute(f'SELECT * FROM "{name}"')))
+                                        for name in names}
+            con.close()
+        return snapshot
+
+    @staticmethod
+    def compare_rows(part:  str,
+                     rows:  dict,
+                     other: dict) -> list:
+        return [f'{part} of {name}' for name in sorted(set(rows) | set(other))
+                if rows.get(name) != other.get(name)]
+
+    @staticmethod
+    def compare_imports(source:  str,
+                        folder:  str,
+                        checked: list = None) -> list:
+        # The parallel import must write the same rows as the sequential one
+        snapshot = Benchmark.snapshot(source, folder, checked)
+        return Benchmark.compare_rows(f'{XMLParser.backend} parallel rows',
+                                      snapshot['parallel rows'], snapshot['sequential rows'])
+
+    @staticmethod
+    def compare_backends(source:  str,
+                         folder:  str,
+                         checked: list = None) -> list:
+        # The workers of the parallel import pick the backend up from the environment
+        snapshots = {}
+        errors = {}
+        for backend in ('stdlib', 'lxml'):
+            os.environ['XML_PARSER'] = backend
+            XMLParser.backend = backend
+            try:
+                snapshots[backend] = Benchmark.snapshot(source, folder, checked)
+            except Exception as e:
+                # lxml for one refuses documents nested deeper than libxml2 allows
+                errors[backend] = f'{type(e).__name__}: {e}'
+
+        if errors:
+            return [f'{backend} failed with {error}' for backend, error in errors.items()]
+
+        mismatches = []
+        for part, value in snapshots['stdlib'].items():
+            other = snapshots['lxml'][part]
+            if part.endswith('rows'):
+                mismatches.extend(Benchmark.compare_rows(part, value, other))
+            elif value != other:
+                mismatches.append(part)
+        for backend, snapshot in snapshots.items():
+            mismatches.extend(Benchmark.compare_rows(f'{backend} parallel rows', snapshot['parallel rows'],
+                                                     snapshot['sequential rows']))
+        return mismatches
+
+    @staticmethod
+    def compare(results:   dict,
+                baseline:  dict,
+                tolerance: float) -> list:
+        # A case regressed when its throughput fell by more than the tolerance
+        regressions = []
+        for case, result in results.items():
+            before = baseline.get(case)
+            if before and result['elements_per_s'] < before['elements_per_s'] * (1 - tolerance):
+                regressions.append(f'{case}: {before["elements_per_s"]} -> {result["elements_per_s"]} elements/s')
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the XML analysis and import on a synthetic BMEcat catalog')
+    parser.add_argument('--records', type=int, default=10000, help='number of ARTICLE records')
+    parser.add_argument('--depth', type=int, default=0, help='extra nesting levels in every ARTICLE_DETAILS')
+    parser.add_argument('--fanout', type=int, default=4, help='average FEATURE count per article')
+    parser.add_argument('--attributes', type=float, default=0.5, help='probability of every optional attribute')
+    parser.add_argument('--namespaces', action='store_true', help='use the BMEcat and an extension namespace')
+    parser.add_argument('--cases', default='analyze,sqlite,sql,sql.gz,parquet,convert2sql',
+                        help='comma separated list of cases')
+    parser.add_argument('--xml', help='benchmark this file instead of a generated one')
+    parser.add_argument('--parser', choices=['auto', 'lxml', 'stdlib'], help='XML parser backend')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare with the JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput loss against the baseline')
+    parser.add_argument('--compare-backends', action='store_true',
+                        help='check that lxml and the standard library give the same analysis, statements and rows')
+    parser.add_argument('--compare-imports', action='store_true',
+                        help='check that the parallel import writes the same rows as the sequential one')
+    parser.add_argument('--checked', help='comma separated paths to import instead of the lists of the analysis')
+    args = parser.parse_args()
+    checked = args.checked.split(',') if args.checked else None
+
+    if args.compare_backends and lxml_etree is None:
+        print('lxml is not installed, there is nothing to compare')
+        return
+
+    if args.parser:
+        # The cases run in fresh processes, which pick the backend up from the environment
+        os.environ['XML_PARSER'] = args.parser
+        XMLParser.backend = args.parser
+    print(f'XML parser: {XMLParser.backend}')
+
+    cases = args.cases.split(',')
+    if 'parquet' in cases and not ArrowWriter.is_available():
+        cases.remove('parquet')
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = args.xml
+        if source:
+            elements = sum(1 for _ in ElementTree.iterparse(source))
+        else:
+            source = os.path.join(folder, 'catalog.xml')
+            start = time.perf_counter()
+            elements = BMEcatGenerator(args.records, args.depth, args.fanout, args.attributes,
+                                       args.namespaces).write(source)
+            print(f'Generated {elements} elements, {os.path.getsize(source) >> 10} KB '
+                  f'in {time.perf_counter() - start:.2f} s')
+
+        if args.compare_backends or args.compare_imports:
+            if args.compare_backends:
+                mismatches = Benchmark.compare_backends(source, folder, checked)
+            else:
+                mismatches = Benchmark.compare_imports(source, folder, checked)
+            for mismatch in mismatches:
+                print(f'Mismatch: {mismatch}')
+            print(f'Results {"differ" if mismatches else "match"}')
+            sys.exit(1 if mismatches else 0)
+
+        results = Benchmark.run(cases, source, folder, elements)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = Benchmark.compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
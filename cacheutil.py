@@ -0,0 +1,101 @@
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import threading
+
+
+ANALYSIS = 'analysis'
+STATEMENTS = 'statements'
+
+
+class ResultCache:
+    # Results keyed by the content hash of the uploaded file, shared by all sessions and
+    # kept across restarts. The least recently used entries are removed when the files
+    # together grow above max_bytes.
+    folder = os.getenv("CACHE_FOLDER", os.path.join('tmp', 'cache'))
+    max_bytes = int(os.getenv("CACHE_SIZE", str(1 << 30)))
+
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_key(*parts) -> str:
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def get_path(kind: str,
+                 key:  str) -> str:
+        return os.path.join(ResultCache.folder, kind, key + '.pickle')
+
+    @staticmethod
+    def get(kind: str,
+            key:  str) -> object:
+        # Returns None for an unknown key
+        path = ResultCache.get_path(kind, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # The modification time orders the entries for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'Cache entry {path} dropped: {e}')
+            ResultCache.remove(path)
+            return None
+        return value
+
+    @staticmethod
+    def put(kind:  str,
+            key:   str,
+            value: object):
+        path = ResultCache.get_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f'{path}.{uuid.uuid4().hex}.part'
+        try:
+            with open(part_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(part_path, path)
+        except:
+            ResultCache.remove(part_path)
+            raise
+        ResultCache.evict()
+
+    @staticmethod
+    def remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def evict():
+        with ResultCache.lock:
+            folders = [os.path.join(ResultCache.folder, kind) for kind in os.listdir(ResultCache.folder)]
+            evict_files(folders, '.pickle', ResultCache.max_bytes)
+
+
+def evict_files(folders:   list,
+                suffix:    str,
+                max_bytes: int,
+                keep:      set = None):
+    # Removes the least recently modified files with the suffix until the rest fit into
+    # max_bytes. The files to keep are never removed, even if they alone are too large.
+    entries = []
+    for folder in folders:
+        with os.scandir(folder) as files:
+            for entry in files:
+                if entry.name.endswith(suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    keep = {os.path.abspath(path) for path in keep or ()}
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) not in keep:
+            ResultCache.remove(path)
+            total -= size
@@ -1,10 +1,10 @@
-
-import xml.etree.ElementTree as ET
 import sqlite3
+import argparse
+
+from maputil import FieldMapping
+from metricsutil import ImportMetrics
+from util import CountingReader, XMLParser
 
-# Database connection setup using langchain SQLDatabase
-conn = sqlite3.connect("amf-data.sqlite3.db")
-cursor = conn.cursor()
 
 # Drop tables if they exist and then create them
 table_creation_statements = {
@@ -60,102 +60,151 @@ table_creation_statements = {
     '''
 }
 
-# Drop tables if they exist
-for table in ['keywords', 'mime_info', 'prices', 'features', 'articles']:
-    cursor.execute(f"DROP TABLE IF EXISTS {table}")
-
-# Create tables
-for table, creation_statement in table_creation_statements.items():
-    cursor.execute(creation_statement)
-
-# Parse the XML
-tree = ET.parse('Data/BME_CAT.xml')
-root = tree.getroot()
-
-
-# Function to insert into the database
-def insert_into_db(table, columns, values):
-    # try:
-        vals = ', '.join("'{}'".format(val) for val in values)
-        cols = ', '.join('{}'.format(col) for col in columns)
-        sql = f'INSERT INTO "{table}" ({cols}) VALUES ({vals})'
-        # print(f'SQL: {sql}')
-        cursor.execute(sql)
-    # except:
-    #     print(f"SQL: {sql}")
-
-
-def text_or_empty(base, key):
-    val = base.find(key)
-    return val.text.replace("'", '') if val is not None else ''
-
-def int_or_empty(base, key):
-    val = base.find(key)
-    return int(val.text) if val is not None else 0
-
-def float_or_empty(base, key):
-    val = base.find(key)
-    return float(val.text) if val is not None else 0
-
-article_id = 0
-
-# Iterate through the XML structure and extract data
-for article in root.findall('.//ARTICLE'):
-    article_id += 1
-    print(f"\r{article_id}", end='')
-
-    detail = article.find('.//ARTICLE_DETAILS')
-
-    if detail is not None:
-        # Extract and insert article data
-        manufacturer_aid = int_or_empty(detail, 'MANUFACTURER_AID')
-        manufacturer_name = text_or_empty(detail, 'MANUFACTURER_NAME')
-        order_number = int_or_empty(detail, 'ARTICLE_ORDER')
-        short_desc = text_or_empty(detail, 'DESCRIPTION_SHORT')
-        long_desc = text_or_empty(detail, 'DESCRIPTION_LONG')
-        ean = int_or_empty(detail, 'EAN')
-        print(f" {ean}", end='  ')
-
-        insert_into_db('articles', 
-                    ['article_id', 'manufacturer_aid', 'manufacturer_name', 
-                        'order_number', 'short_description', 'long_description', 'ean'], 
-                    [article_id, manufacturer_aid, manufacturer_name,
-                        order_number, short_desc, long_desc, ean])
-
-        # Extract and insert feature data
-        for feature in article.findall('.//FEATURE'):
-            name = text_or_empty(feature, 'FNAME')
-            value = text_or_empty(feature, 'FVALUE')
-            unit = text_or_empty(feature, 'FUNIT')
-            insert_into_db('features',
-                            ['article_id', 'name', 'value', 'unit'], 
-                            [article_id, name, value, unit])
-
-        # Extract and insert price data
-        for price in article.findall('.//ARTICLE_PRICE'):
-            amount = float_or_empty(price, 'PRICE_AMOUNT')
-            currency = text_or_empty(price, 'PRICE_CURRENCY')
-            tax = float_or_empty(price, 'TAX')
-            lower_bound = int_or_empty(price, 'LOWER_BOUND')
-            insert_into_db('prices',
-                          ['article_id', 'amount', 'currency', 'tax', 'lower_bound'],
-                          [article_id, amount, currency, tax, lower_bound])
-
-        # Extract and insert MIME info
-        for mime in article.findall('.//MIME'):
-            mime_type = text_or_empty(mime, 'MIME_TYPE')
-            source = text_or_empty(mime, 'MIME_SOURCE')
-            purpose = text_or_empty(mime, 'MIME_PURPOSE')
-            insert_into_db('mime_info',
-                           ['article_id', 'mime_type', 'source', 'purpose'], 
-                           [article_id, mime_type, source, purpose])
-
-        # Extract and insert keywords
-        for keyword_elem in article.findall('.//KEYWORD'):
-            keyword = keyword_elem.text
-            insert_into_db('keywords',
-                           ['article_id', 'keyword'],
-                           [article_id, keyword])
-
-    conn.commit()
+# The rows of every ARTICLE, like the BMEcat export of our supplier catalogs
+bmecat_mapping = {
+    'record': 'ARTICLE',
+    'id': 'article_id',
+    'required': ['//ARTICLE_DETAILS'],
+    'tables': {
+        'articles': {'rows': '.', 'columns': {
+            'manufacturer_aid': ('//ARTICLE_DETAILS/MANUFACTURER_AID', int, 0),
+            'manufacturer_name': '//ARTICLE_DETAILS/MANUFACTURER_NAME',
+            'order_number': ('//ARTICLE_DETAILS/ARTICLE_ORDER', int, 0),
+            'short_description': '//ARTICLE_DETAILS/DESCRIPTION_SHORT',
+            'long_description': '//ARTICLE_DETAILS/DESCRIPTION_LONG',
+            'ean': ('//ARTICLE_DETAILS/EAN', int, 0),
+        }},
+        'features': {'rows': '//FEATURE', 'columns': {
+            'name': 'FNAME',
+            'value': 'FVALUE',
+            'unit': 'FUNIT',
+        }},
+        'prices': {'rows': '//ARTICLE_PRICE', 'columns': {
+            'amount': ('PRICE_AMOUNT', float, 0),
+            'currency': 'PRICE_CURRENCY',
+            'tax': ('TAX', float, 0),
+            'lower_bound': ('LOWER_BOUND', int, 0),
+        }},
+        'mime_info': {'rows': '//MIME', 'columns': {
+            'mime_type': 'MIME_TYPE',
+            'source': 'MIME_SOURCE',
+            'purpose': 'MIME_PURPOSE',
+        }},
+        'keywords': {'rows': '//KEYWORD', 'columns': {
+            'keyword': ('.', None, None),
+        }},
+    },
+}
+
 
+class BMEcatSQL:
+
+    @staticmethod
+    def create_tables(conn: sqlite3.Connection):
+        for table in reversed(table_creation_statements):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        for table, creation_statement in table_creation_statements.items():
+            conn.execute(creation_statement)
+
+
+    @staticmethod
+    def insert_rows(conn:     sqlite3.Connection,
+                    mapping:  FieldMapping,
+                    rows:     dict,
+                    progress: ImportMetrics = None):
+        # In the order of the mapping, the articles go first as the other tables reference them
+        for table in mapping.tables:
+            columns = mapping.get_columns(table)
+            if not rows[table]:
+                continue
+            cols = ', '.join(columns)
+            params = ', '.join('?' * len(columns))
+            sql = f'INSERT INTO "{table}" ({cols}) VALUES ({params})'
+            if progress:
+                progress.add_rows(table, len(rows[table]))
+                progress.enter('sql')
+            try:
+                conn.executemany(sql, rows[table])
+            except:
+                print(f'Last SQL: {sql}')
+                raise
+            if progress:
+                progress.leave('sql')
+            rows[table].clear()
+
+
+    @staticmethod
+    def import_file(source:      str,
+                    database:    str,
+                    batch_size:  int = 10000,
+                    commit_size: int = 100000,
+                    progress:    ImportMetrics = None,
+                    mapping:     FieldMapping = None,
+                    elements:    bool = False) -> int:
+        # Rows are written with executemany every batch_size rows and committed every
+        # commit_size articles. Returns the number of articles. The progress counts the
+        # articles, with elements all elements parsed, which slows lxml down.
+        mapping = mapping or FieldMapping(bmecat_mapping)
+        conn = sqlite3.connect(database)
+        BMEcatSQL.create_tables(conn)
+
+        rows = {table: [] for table in mapping.tables}
+        pending = 0
+        article_id = 0
+        reader = CountingReader(source)
+        try:
+            if progress:
+                progress.enter('parse')
+            for article, count in XMLParser.iter_records(reader, mapping.record, elements):
+                article_id += 1
+                if progress:
+                    progress.leave('parse')
+                    progress.update(reader.count, count, pending)
+                    progress.enter('build')
+
+                if mapping.extract(article, rows, article_id):
+                    pending = sum(map(len, rows.values()))
+                    if pending >= batch_size:
+                        BMEcatSQL.insert_rows(conn, mapping, rows, progress)
+                        pending = 0
+
+                if article_id % commit_size == 0:
+                    BMEcatSQL.insert_rows(conn, mapping, rows, progress)
+                    pending = 0
+                    conn.commit()
+                    print(f"\r{article_id}", end='')
+
+                if progress:
+                    progress.leave('build')
+                    progress.enter('parse')
+
+            BMEcatSQL.insert_rows(conn, mapping, rows, progress)
+            conn.commit()
+            print(f"\r{article_id}")
+        finally:
+            reader.close()
+            conn.close()
+
+        return article_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import the articles of a BMEcat catalog into a sqlite database')
+    parser.add_argument('source', nargs='?', default='Data/BME_CAT.xml', help='BMEcat XML file')
+    parser.add_argument('database', nargs='?', default='amf-data.sqlite3.db', help='sqlite database file')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per executemany')
+    parser.add_argument('--commit-size', type=int, default=100000, help='articles per transaction')
+    parser.add_argument('--count-elements', action='store_true', help='report elements instead of articles in the metrics')
+    args = parser.parse_args()
+
+    metrics = ImportMetrics(f'BMEcat {args.source}')
+    metrics.start()
+    articles = BMEcatSQL.import_file(args.source, args.database, args.batch_size, args.commit_size, metrics,
+                                     elements=args.count_elements)
+    metrics.finish()
+    metrics.log('done')
+    print(f'{articles} articles imported into {args.database}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import re
+import sqlite3
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import sqlalchemy
+
+from cacheutil import ResultCache
+
+# Keys of the pooled objects of a database file
+STAT = 'stat'
+CONNECTION = 'connection'
+ENGINE = 'engine'
+SCHEMA = 'schema'
+
+
+class ConnectionPool:
+    # Read-only connections and engines per database file, shared by all sessions and reruns.
+    # The entries of a file are dropped when it is deleted or its inode, size or modification
+    # time changes, an import that writes or replaces the file starts a new entry.
+    #
+    # SQLITE_IMMUTABLE=1 also opens the files as immutable, sqlite then skips all locking and
+    # change detection. That is only safe when the files are replaced but never written in place.
+    mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", str(256 << 20)))
+    immutable = os.getenv("SQLITE_IMMUTABLE", "0") == "1"
+
+    # Reentrant, a factory may ask the pool for the connection or engine of its file
+    lock = threading.RLock()
+    entries = {}
+
+    @staticmethod
+    def get_stat(path: str) -> tuple:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def get_uri(path: str) -> str:
+        uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+        return uri + '&immutable=1' if ConnectionPool.immutable else uri
+
+    @staticmethod
+    def connect(path: str) -> sqlite3.Connection:
+        # A new connection of its own, the pool hands out shared ones
+        conn = sqlite3.connect(ConnectionPool.get_uri(path), uri=True, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size={ConnectionPool.mmap_size}')
+        return conn
+
+    @staticmethod
+    def get_entry(path: str) -> dict:
+        # Called with the lock held
+        path = os.path.abspath(path)
+        try:
+            stat = ConnectionPool.get_stat(path)
+        except FileNotFoundError:
+            ConnectionPool.remove(path)
+            raise
+
+        entry = ConnectionPool.entries.get(path)
+        if entry is None or entry[STAT] != stat:
+            ConnectionPool.remove(path)
+            entry = ConnectionPool.entries[path] = {STAT: stat}
+        return entry
+
+    @staticmethod
+    def get_object(path:    str,
+                   name:    str,
+                   factory: callable) -> object:
+        # Anything built from a database file, factory(path) is called once per file version
+        with ConnectionPool.lock:
+            entry = ConnectionPool.get_entry(path)
+            if name not in entry:
+                entry[name] = factory(path)
+            return entry[name]
+
+    @staticmethod
+    def get_connection(path: str) -> sqlite3.Connection:
+        # sqlite serializes the calls of the threads sharing a connection
+        return ConnectionPool.get_object(path, CONNECTION, ConnectionPool.connect)
+
+    @staticmethod
+    def get_engine(path: str) -> sqlalchemy.Engine:
+        return ConnectionPool.get_object(path, ENGINE, lambda path: sqlalchemy.create_engine(
+            'sqlite://', creator=lambda: ConnectionPool.connect(path)))
+
+    @staticmethod
+    def remove(path: str):
+        # Connections still in use by another session are closed when they are released
+        entry = ConnectionPool.entries.pop(os.path.abspath(path), None)
+        if entry and ENGINE in entry:
+            entry[ENGINE].dispose()
+
+    @staticmethod
+    def evict(path: str):
+        with ConnectionPool.lock:
+            ConnectionPool.remove(path)
+
+
+class SchemaCache:
+    # Compact descriptions of the tables of a database file for the SQL agent: the CREATE
+    # statement and a few sample rows, like SQLDatabase.get_table_info writes them. They are
+    # kept in the pool and in the result cache by the size and modification time of the
+    # file, so neither a rerun nor a restart queries the schema of a known file again.
+    sample_rows = 3
+    max_value_length = 100
+
+    @staticmethod
+    def get_key(path: str) -> str:
+        stat = os.stat(path)
+        return ResultCache.get_key(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def get_table_info(path: str) -> dict:
+        # Table name to description
+        return ConnectionPool.get_object(path, SCHEMA, SchemaCache.load)
+
+    @staticmethod
+    def load(path: str) -> dict:
+        key = SchemaCache.get_key(path)
+        info = ResultCache.get(SCHEMA, key)
+        if info is None:
+            info = SchemaCache.describe(path)
+            ResultCache.put(SCHEMA, key, info)
+        return info
+
+    @staticmethod
+    def describe(path: str) -> dict:
+        conn = ConnectionPool.get_connection(path)
+        tables = conn.execute("SELECT name, sql FROM sqlite_master "
+                              "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+        info = {}
+        for table, create in tables:
+            cursor = conn.execute(f'SELECT * FROM "{table}" LIMIT {SchemaCache.sample_rows}')
+            columns = '\t'.join(column[0] for column in cursor.description)
+            rows = '\n'.join('\t'.join(str(value)[:SchemaCache.max_value_length] for value in row)
+                             for row in cursor.fetchall())
+            create = re.sub(r'\s+', ' ', create)
+            info[table] = f"{create}\n\n/*\n{SchemaCache.sample_rows} rows from {table} table:\n{columns}\n{rows}\n*/"
+        return info
+
+
+class TablePager:
+    # Browses a table page by page in the order of its integer primary key. A page is read
+    # with WHERE key > the last key of the page before, so every page costs the same however
+    # far it is from the start. Each page is fetched completely and its cursor closed right
+    # away, an open cursor would hold a read lock that blocks every import into the database.
+    # Between reruns only the keys of the pages are kept.
+    path: str
+    table: str
+    key: str
+    page_size: int
+
+    # The row count of a large table takes a while, it is not waited for
+    counter = ThreadPoolExecutor(max_workers=2, thread_name_prefix='row-count')
+
+    def __init__(self,
+                 path:      str,
+                 table:     str,
+                 page_size: int = 100):
+        self.path = path
+        self.table = table
+        self.page_size = page_size
+        self.key = TablePager.get_key_column(ConnectionPool.get_connection(path), table)
+
+        # The key before the first row of each page up to the current one, and the last key
+        # of the current page if there may be another one
+        self.starts = [None]
+        self.next_key = None
+
+        self.count = TablePager.counter.submit(TablePager.count_rows, path, table)
+
+    @staticmethod
+    def get_key_column(conn:  sqlite3.Connection,
+                       table: str) -> str:
+        # An INTEGER PRIMARY KEY like the _ID columns of the import is the rowid itself,
+        # any other table is paged by its rowid
+        columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        keys = [(name, type) for _, name, type, _, _, pk in columns if pk]
+        if len(keys) == 1 and keys[0][1].upper() == 'INTEGER':
+            return keys[0][0]
+        return 'rowid'
+
+    @staticmethod
+    def count_rows(path:  str,
+                   table: str) -> int:
+        # A connection of its own, the shared one would be blocked while counting
+        conn = ConnectionPool.connect(path)
+        try:
+            return conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        finally:
+            conn.close()
+
+    def get_count(self) -> int:
+        # None while the rows are still counted
+        return self.count.result() if self.count.done() else None
+
+    def get_page_number(self) -> int:
+        return len(self.starts)
+
+    def has_next(self) -> bool:
+        return self.next_key is not None
+
+    def get_page(self) -> pd.DataFrame:
+        after = self.starts[-1]
+        where = '' if after is None else f'WHERE "{self.key}" > ?'
+        sql = f'SELECT "{self.key}", * FROM "{self.table}" {where} ORDER BY "{self.key}" LIMIT ?'
+        params = (self.page_size,) if after is None else (after, self.page_size)
+        cursor = ConnectionPool.get_connection(self.path).cursor()
+        try:
+            rows = cursor.execute(sql, params).fetchall()
+            # The key comes first and is not shown, unless it is the rowid it is a column anyway
+            columns = [column[0] for column in cursor.description[1:]]
+        except:
+            print(f'Last SQL: {sql}')
+            raise
+        finally:
+            cursor.close()
+
+        self.next_key = rows[-1][0] if len(rows) == self.page_size else None
+        return pd.DataFrame([row[1:] for row in rows], columns=columns)
+
+    def next(self):
+        if self.has_next():
+            self.starts.append(self.next_key)
+
+    def previous(self):
+        if len(self.starts) > 1:
+            self.starts.pop()
+
+    def first(self):
+        self.starts = [None]
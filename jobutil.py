@@ -0,0 +1,180 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metricsutil import ImportMetrics
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobConflict(Exception):
+    pass
+
+
+class Job(ImportMetrics):
+    id: str
+    owner: str
+    target: str
+    source: str
+    state: str
+    result: object
+    error: str
+
+    def __init__(self,
+                 name:        str,
+                 owner:       str,
+                 total_bytes: int = 0,
+                 target:      str = None,
+                 source:      str = None):
+        super().__init__(name, total_bytes)
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.target = target
+        self.source = source
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.cancelled = threading.Event()
+
+    def update(self,
+               bytes_read: int,
+               elements:   int,
+               queue:      int):
+        # Called by the import for every record, so this is where a cancel takes effect
+        super().update(bytes_read, elements, queue)
+        self.check()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f'Job {self.name} cancelled')
+
+    def get_progress(self) -> float:
+        if self.state == DONE:
+            return 1.0
+        if not self.total_bytes:
+            return 0.0
+        return min(self.bytes_read / self.total_bytes, 1.0)
+
+    def get_status(self) -> dict:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'progress': self.get_progress(),
+            'error': self.error,
+            **self.get_metrics(),
+        }
+
+
+class JobRunner:
+    # The jobs live in the server process, so they survive reruns and closed browser tabs.
+    # All sessions share the pool, at most max_workers imports run at the same time.
+    max_workers = int(os.getenv("IMPORT_WORKERS", "2"))
+    max_age = 24 * 3600
+
+    lock = threading.Lock()
+    jobs = {}
+    executor = None
+
+    @staticmethod
+    def get_executor() -> ThreadPoolExecutor:
+        with JobRunner.lock:
+            if JobRunner.executor is None:
+                JobRunner.executor = ThreadPoolExecutor(max_workers=JobRunner.max_workers,
+                                                        thread_name_prefix='import-job')
+            return JobRunner.executor
+
+    @staticmethod
+    def submit(name:        str,
+               owner:       str,
+               func:        callable,
+               *args,
+               total_bytes: int = 0,
+               target:      str = None,
+               source:      str = None) -> Job:
+        # func is called with the job as its first argument, its return value is the job result.
+        # Only one unfinished job at a time may write to a target, like a database file or folder.
+        # The source is the file the job reads, it is kept until the job has finished.
+        job = Job(name, owner, total_bytes, target, source)
+        with JobRunner.lock:
+            JobRunner.remove_finished()
+            if target is not None:
+                for other in JobRunner.jobs.values():
+                    if other.target == target and other.state not in FINISHED:
+                        raise JobConflict(f'Job {other.name} is already writing to {target}')
+            JobRunner.jobs[job.id] = job
+        JobRunner.get_executor().submit(JobRunner.run, job, func, args)
+        return job
+
+    @staticmethod
+    def run(job:  Job,
+            func: callable,
+            args: tuple):
+        # The final state is only set once the job has finished, so remove_finished never
+        # sees a finished job without its finish time
+        if job.cancelled.is_set():
+            job.finish()
+            job.state = CANCELLED
+            return
+
+        job.state = RUNNING
+        job.start()
+        print(f'Job started: {job.name}')
+        state = FAILED
+        try:
+            job.result = func(job, *args)
+            state = DONE
+        except JobCancelled:
+            state = CANCELLED
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+        finally:
+            job.finish()
+            job.state = state
+            print(f'Job {job.state}: {job.name}')
+            job.log(job.state)
+
+    @staticmethod
+    def get_job(job_id: str) -> Job:
+        with JobRunner.lock:
+            return JobRunner.jobs.get(job_id)
+
+    @staticmethod
+    def get_jobs(owner: str = None) -> list:
+        with JobRunner.lock:
+            jobs = [job for job in JobRunner.jobs.values() if owner is None or job.owner == owner]
+        return sorted(jobs, key=lambda job: job.created)
+
+    @staticmethod
+    def get_sources() -> set:
+        # The files read by the queued and running jobs
+        with JobRunner.lock:
+            return {job.source for job in JobRunner.jobs.values()
+                    if job.source is not None and job.state not in FINISHED}
+
+    @staticmethod
+    def cancel(job_id: str):
+        job = JobRunner.get_job(job_id)
+        if job:
+            job.cancelled.set()
+
+    @staticmethod
+    def remove_finished():
+        # Called with the lock held
+        limit = time.time() - JobRunner.max_age
+        for job_id in [job_id for job_id, job in JobRunner.jobs.items()
+                       if job.state in FINISHED and job.finished is not None and job.finished < limit]:
+            del JobRunner.jobs[job_id]
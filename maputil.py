@@ -0,0 +1,153 @@
+import re
+from xml.etree import ElementTree
+
+
+# Marks a column that has not been found yet, None is a valid value
+UNSET = object()
+
+
+class FieldMapping:
+    # Extracts table rows from a record element with a declarative spec:
+    #
+    #   {'record': 'ARTICLE',             local name of the record elements
+    #    'id': 'article_id',              optional first column of every row, the record number
+    #    'required': ['//ARTICLE_DETAILS'], records without these paths give no rows
+    #    'tables': {
+    #        'features': {'rows': '//FEATURE',                 row elements, '.' is the record itself
+    #                     'columns': {'name': 'FNAME',         text of the first matching element
+    #                                 'value': ('FVALUE', float, 0.0)}}}}   with converter and default
+    #
+    # Paths are relative and use local names, '/' is a child and '//' any descendant.
+    # All tables are filled in a single pass over the record.
+    record: str
+    id: str
+    tables: dict
+
+    def __init__(self, spec: dict):
+        self.record = spec['record']
+        self.id = spec.get('id')
+        self.required = [FieldMapping.compile_path(path) for path in spec.get('required', [])]
+
+        self.tables = {}
+        for table, table_spec in spec['tables'].items():
+            columns = []
+            for column, column_spec in table_spec['columns'].items():
+                if isinstance(column_spec, str):
+                    column_spec = (column_spec, None, '')
+                path, convert, default = column_spec
+                columns.append((column, FieldMapping.compile_path(path), convert, default))
+            self.tables[table] = (FieldMapping.compile_path(table_spec['rows']), columns)
+
+        # The matches are resolved once per distinct path, the records of a catalog share them
+        self.names = {}
+        self.paths = {}
+        self.plans = {}
+
+    @staticmethod
+    def compile_path(path: str) -> re.Pattern:
+        # Matched against the slash separated local names below the context element
+        parts = []
+        descendant = False
+        for step in path.strip().split('/'):
+            if step == '.':
+                continue
+            if not step:
+                descendant = True
+                continue
+            parts.append(('(?:[^/]+/)*' if descendant else '') + re.escape(step))
+            descendant = False
+        return re.compile('/'.join(parts))
+
+    def get_columns(self, table: str) -> tuple:
+        columns = tuple(column for column, _, _, _ in self.tables[table][1])
+        return (self.id, *columns) if self.id else columns
+
+    def get_child_path(self, path: str, tag: str) -> str:
+        key = (path, tag)
+        child_path = self.names.get(key)
+        if child_path is None:
+            name = tag.rsplit('}', 1)[-1]
+            child_path = self.names[key] = path + '/' + name if path else name
+        return child_path
+
+    def get_path_actions(self, path: str) -> {list, list}:
+        # The tables with a row at this path and the required paths it matches
+        actions = self.paths.get(path)
+        if actions is None:
+            rows = [table for table, (pattern, _) in self.tables.items() if pattern.fullmatch(path)]
+            required = [i for i, pattern in enumerate(self.required) if pattern.fullmatch(path)]
+            actions = self.paths[path] = (rows, required)
+        return actions
+
+    def get_column(self, table: str, row_path: str, path: str) -> int:
+        # The column paths are relative to the row element
+        if path == row_path:
+            relative = ''
+        else:
+            relative = path[len(row_path) + 1:] if row_path else path
+        for i, (_, pattern, _, _) in enumerate(self.tables[table][1]):
+            if pattern.fullmatch(relative):
+                return i
+        return -1
+
+    def get_plan(self, path: str, rows: tuple) -> tuple:
+        # What to do at an element with this path inside the open rows, a tuple of (table, row_path).
+        # Returns the tables that start a row here, the required paths found, the open rows
+        # below and the (row, column, convert) values taken from the text of the element.
+        key = (path, rows)
+        plan = self.plans.get(key)
+        if plan is None:
+            tables, required = self.get_path_actions(path)
+            rows = rows + tuple((table, path) for table in tables)
+            columns = []
+            for i, (table, row_path) in enumerate(rows):
+                index = self.get_column(table, row_path, path)
+                if index >= 0:
+                    columns.append((i, index, self.tables[table][1][index][2]))
+            plan = self.plans[key] = (tables, required, rows, columns)
+        return plan
+
+    def extract(self,
+                record:    ElementTree,
+                rows:      dict,
+                record_id: int = None) -> bool:
+        # Appends the rows of the record to rows[table], returns False if a required path is missing
+        found = [False] * len(self.required)
+        record_rows = {table: [] for table in self.tables}
+
+        stack = [(record, '', (), ())]
+        while stack:
+            elem, path, open_rows, values_list = stack.pop()
+
+            tables, required, open_rows, columns = self.get_plan(path, open_rows)
+            for i in required:
+                found[i] = True
+            if tables:
+                values_list = values_list + tuple(self.add_row(record_rows[table], table) for table in tables)
+
+            for i, index, convert in columns:
+                values = values_list[i]
+                if values[index] is UNSET:
+                    text = elem.text
+                    values[index] = text if convert is None or text is None else convert(text)
+
+            if len(elem):
+                stack.extend((child, self.get_child_path(path, child.tag), open_rows, values_list)
+                             for child in elem[::-1])
+
+        if not all(found):
+            return False
+
+        for table, table_rows in record_rows.items():
+            columns = self.tables[table][1]
+            target = rows[table]
+            for values in table_rows:
+                row = tuple(columns[i][3] if value is UNSET or value is None else value
+                            for i, value in enumerate(values))
+                target.append((record_id, *row) if self.id else row)
+        return True
+
+    def add_row(self, table_rows: list, table: str) -> list:
+        values = [UNSET] * len(self.tables[table][1])
+        table_rows.append(values)
+        return values
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+
+
+class ImportMetrics:
+    name: str
+    total_bytes: int
+    bytes_read: int
+    elements: int
+    queue: int
+    rows: dict
+    times: dict
+
+    # Seconds between two progress entries in the metrics log
+    log_interval = 5.0
+
+    def __init__(self,
+                 name:        str,
+                 total_bytes: int = 0,
+                 log_path:    str = None):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.log_path = log_path or os.getenv("METRICS_LOG")
+        self.bytes_read = 0
+        self.elements = 0
+        self.queue = 0
+        self.rows = {}
+        self.times = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.logged = 0.0
+
+        # Timers are exclusive, a nested timer pauses the one it was started in
+        self.timers = []
+        self.mark = 0.0
+
+    def start(self):
+        self.started = time.time()
+        self.logged = self.started
+
+    def finish(self):
+        # Whatever still waited in the batches is written or discarded by now
+        self.finished = time.time()
+        self.queue = 0
+        while self.timers:
+            self.leave(self.timers[-1])
+
+    def add_rows(self,
+                 tablename: str,
+                 count:     int):
+        with self.lock:
+            self.rows[tablename] = self.rows.get(tablename, 0) + count
+
+    def update(self,
+               bytes_read: int,
+               elements:   int,
+               queue:      int):
+        # Called by the import for every record
+        self.bytes_read = bytes_read
+        self.elements = elements
+        self.queue = queue
+        if self.log_path and time.time() - self.logged >= self.log_interval:
+            self.log('progress')
+
+    def enter(self,
+              name: str):
+        now = time.perf_counter()
+        if self.timers:
+            outer = self.timers[-1]
+            with self.lock:
+                self.times[outer] = self.times.get(outer, 0.0) + now - self.mark
+        self.timers.append(name)
+        self.mark = now
+
+    def leave(self,
+              name: str):
+        if not self.timers or self.timers[-1] != name:
+            return
+        now = time.perf_counter()
+        self.timers.pop()
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def get_seconds(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def get_metrics(self) -> dict:
+        # The import thread keeps adding rows and times, the page reads them from its own
+        with self.lock:
+            rows = dict(self.rows)
+            times = dict(self.times)
+        seconds = self.get_seconds()
+        total_rows = sum(rows.values())
+        return {
+            'name': self.name,
+            'seconds': round(seconds, 2),
+            'bytes': self.bytes_read,
+            'total_bytes': self.total_bytes,
+            'elements': self.elements,
+            'elements_per_s': round(self.elements / seconds) if seconds else 0,
+            'rows': total_rows,
+            'rows_per_s': round(total_rows / seconds) if seconds else 0,
+            'queue': self.queue,
+            'tables': rows,
+            'times': {name: round(value, 2) for name, value in times.items()},
+        }
+
+    def log(self,
+            event: str):
+        self.logged = time.time()
+        entry = {'time': round(self.logged, 3), 'event': event, **self.get_metrics()}
+        line = json.dumps(entry)
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(line + '\n')
+        else:
+            print(f'Import metrics: {line}')
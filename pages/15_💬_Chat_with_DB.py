@@ -13,6 +13,7 @@ from streamlit_extras.app_logo import add_logo
 
 from password import check_password
 from pageutil import ChatBase
+from dbutil import ConnectionPool, SchemaCache
 
 
 # Load environment variables
@@ -24,11 +25,30 @@ st.title("V&S DB ChatBot")
 with st.sidebar:
     add_logo("img/v-und-s.png")
 
+class CachedSQLDatabase(SQLDatabase):
+    # The schema tool of the agent is answered from the cached table descriptions,
+    # the tables are neither reflected nor sampled for every question
+    def get_table_info(self, table_names: list[str] = None, get_col_comments: bool = False) -> str:
+        names = self.get_usable_table_names() if table_names is None else table_names
+        if get_col_comments or not all(name in self._custom_table_info for name in names):
+            return super().get_table_info(table_names, get_col_comments)
+        return "\n\n".join(self._custom_table_info[name] for name in names)
+
+    @staticmethod
+    def from_file(path: str) -> SQLDatabase:
+        return CachedSQLDatabase(ConnectionPool.get_engine(path), lazy_table_reflection=True,
+                                 custom_table_info=SchemaCache.get_table_info(path))
+
+
 class DBChatBot(ChatBase):
 
     TEMPERATURE = 'temperature'
     MODEL_NAME = 'model_name'
     DATABASE = 'database'
+    AGENT = 'agent'
+
+    # Key of the SQLDatabase in the connection pool
+    SQL_DATABASE = 'sql_database'
 
     def __init__(self):
         print('Init OpenAIChatBot')
@@ -60,16 +80,27 @@ class DBChatBot(ChatBase):
         model = self.get_model()
         dbname = self.get_db()
         if dbname:
+            dir = os.getenv("DATABASE_DIR")
+            file_name = f'{dir}/{dbname}'
+
+            # The schema is read once per database file and shared by all sessions
+            db = ConnectionPool.get_object(file_name, self.SQL_DATABASE, CachedSQLDatabase.from_file)
+
+            # The model and agent are only built again when a setting or the database changed
+            setup = (model, temp, db)
+            agent = self.get_session_state(self.AGENT)
+            if agent and agent[0] == setup:
+                _, self.llm, self.db, self.agent_executor = agent
+                return
+
             print(f'Setup OpenAI Model: {model}, Temperature: {temp}')
             self.llm = ChatOpenAI(temperature=temp, model_name=model)
 
-            dir = os.getenv("DATABASE_DIR")
-            file_name = f'sqlite:///{dir}/{dbname}'
-
             print(f'Database: {file_name}')
-            self.db = SQLDatabase.from_uri(file_name)
+            self.db = db
 
             self.agent_executor = create_sql_agent(self.llm, db=self.db, agent_type="openai-tools", verbose=True)
+            self.set_session_state(self.AGENT, (setup, self.llm, self.db, self.agent_executor))
         else:
             print('No DB selected!')
 
@@ -99,7 +130,6 @@ class DBChatBot(ChatBase):
             temp = st.slider("Temperatur", 0.0, 1.0, self.get_temp())
             if temp:
                 self.set_session_state(self.TEMPERATURE, temp)
-                self.setup_llm()
 
             models = self.get_model_names()
             idx = models.index(self.get_model())
@@ -108,12 +138,11 @@ class DBChatBot(ChatBase):
             model = st.selectbox("Model", options = models, index = idx)
             if model:
                 self.set_session_state(self.MODEL_NAME, model)
-                self.setup_llm()
 
             dbname = st.selectbox("Select Database:", options = self.get_all_dbs())
             if dbname:
                 self.set_session_state(self.DATABASE, dbname)
-                self.setup_llm()
+            self.setup_llm()
 
             if st.button("Clear chat", use_container_width=True):
                 self.clear_history()
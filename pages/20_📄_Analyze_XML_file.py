@@ -1,7 +1,8 @@
+import io
 import os
 import sqlite3
+import zipfile
 import tempfile
-from xml.etree import ElementTree
 from typing import IO
 
 import streamlit as st
@@ -12,8 +13,10 @@ from dotenv import load_dotenv
 
 from password import check_password
 from pageutil import Page
+from jobutil import Job, JobConflict, JobRunner, DONE, FAILED, FINISHED
+from cacheutil import ResultCache, ANALYSIS, STATEMENTS
 from xmlutil import XML2TreeSelect
-from sqlutil import CreateSQL, InsertSQL, SQLGlobals
+from sqlutil import ArrowWriter, CreateSQL, InsertSQL, IncrementalSQL, SQLDumpWriter, SQLGlobals
 from util import save_temp_file
 
 
@@ -26,34 +29,63 @@ with st.sidebar:
     add_logo("img/v-und-s.png")
 
 
-# @st.cache_data
 @st.spinner('Analyzing XML structure..')
 def analyze_xml_file_structure(uploaded_file: str,
-                               ignore_ns:     bool) -> {dict, list}:
+                               ignore_ns:     bool,
+                               max_records:   int = None,
+                               max_bytes:     int = None,
+                               sample_every:  int = 1,
+                               key:           str = None) -> {dict, list}:
+    # With a key from the content hash of the file the result is cached for all sessions
+    if key:
+        cached = ResultCache.get(ANALYSIS, key)
+        if cached:
+            return cached
+
     msg = st.empty()
     with msg.container():
         st.write("Parsing...")
 
-        tree = ElementTree.parse(uploaded_file)
-
-        struct, checked = XML2TreeSelect.convert(tree.getroot(), ignore_ns)
+        struct, checked = XML2TreeSelect.convert_file(uploaded_file, ignore_ns, max_records,
+                                                      max_bytes, sample_every)
 
         # clear the answer
         msg.empty()
 
-        return struct, checked
+    if key:
+        ResultCache.put(ANALYSIS, key, (struct, checked))
+    return struct, checked
+
+
+def create_statements(struct:    dict,
+                      checked:   list,
+                      full_name: bool,
+                      key:       str = None) -> {list, dict}:
+    # key identifies the analysis the struct comes from
+    if key:
+        key = ResultCache.get_key(key, sorted(checked), full_name)
+        cached = ResultCache.get(STATEMENTS, key)
+        if cached:
+            return cached
+
+    statements = []
+    tables = {}
+    CreateSQL.search_checked_nodes(struct, checked, statements, full_name, tables)
+    if key:
+        ResultCache.put(STATEMENTS, key, (statements, tables))
+    return statements, tables
 
 
-@st.spinner('Insert into SQL Database..')
-def insert_sql(db: SQLGlobals, file_uploaded):
-    tree = ElementTree.parse(file_uploaded)
-    root = tree.getroot()
+def insert_sql(db: SQLGlobals, file_uploaded, parallel: bool = False, lookups: bool = False):
     db.begin()
-    InsertSQL.search_checked_nodes(root, "", db)
+    if parallel:
+        InsertSQL.parallel_checked_nodes(file_uploaded, db)
+    else:
+        InsertSQL.stream_checked_nodes(file_uploaded, db)
+    db.create_indexes(lookups)
     db.end()
 
 
-@st.spinner('Insert into SQL Database..')
 def create_sql(db: SQLGlobals, statements: list):
     db.begin()
     for stmt in statements:
@@ -65,18 +97,91 @@ def create_sql(db: SQLGlobals, statements: list):
     db.end()
 
 
+def update_sql(db: SQLGlobals, statements: list, file_uploaded, lookups: bool = False) -> dict:
+    db.begin()
+    IncrementalSQL.create_sql(db, statements)
+    stats = IncrementalSQL.stream_checked_nodes(file_uploaded, db)
+    db.create_indexes(lookups)
+    db.end()
+    return stats
+
+
+def run_import(job:           Job,
+               url:           str,
+               statements:    list,
+               file_uploaded: str,
+               checked:       list,
+               ignore_ns:     bool,
+               full_name:     bool,
+               tables:        dict,
+               parallel:      bool = False,
+               incremental:   bool = False,
+               lookups:       bool = False) -> dict:
+    # Runs in a job thread, so no streamlit calls in here
+    db = SQLGlobals(url, checked, ignore_ns, full_name, tables=tables)
+    db.progress = job
+    try:
+        if incremental:
+            return update_sql(db, statements, file_uploaded, lookups)
+
+        if statements:
+            create_sql(db, statements)
+        insert_sql(db, file_uploaded, parallel, lookups)
+    finally:
+        db.close()
+
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def zip_folder(folder: str) -> bytes:
+    # Parquet files are already compressed, they are only stored in the archive
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(folder)):
+            archive.write(os.path.join(folder, name), name)
+    return data.getvalue()
+
+
 class AnalyzeXMLPage(Page):
 
     UPLOADED_XML = 'uploaded_xml'
     CHECKED_NODES = 'checked_nodes'
     STATEMENTS = 'statements'
+    TABLES = 'tables'
     FILE_UPLOADED = 'file_uploaded'
+    FILE_HASH = 'file_hash'
+    ANALYSIS_KEY = 'analysis_key'
+    UPLOAD_ID = 'upload_id'
     XML_ANALYZED = 'xml_analyzed'
     DB_CREATED = 'db_created'
     SQL_CREATED = 'sql_created'
+    PARQUET_CREATED = 'parquet_created'
     DB_INSERTED = 'db_inserted'
     IGNORE_NS = 'ignore_ns'
     FULL_NAME = 'full_name'
+    PARALLEL = 'parallel'
+    INCREMENTAL = 'incremental'
+    LOOKUPS = 'lookups'
+    COMPRESSION = 'compression'
+    SAMPLE = 'sample'
+    XML_SAMPLED = 'xml_sampled'
+    JOB = 'job'
+    IMPORT_STATS = 'import_stats'
+    SAMPLE_RECORDS = 'sample_records'
+    SAMPLE_EVERY = 'sample_every'
+
+    # A sample analysis never reads more than this from the file
+    SAMPLE_BYTES = 256 << 20
+
+    # file extension and mime type per SQL file compression
+    COMPRESSIONS = {
+        'none': ('', 'text/sql'),
+        'gzip': ('.gz', 'application/gzip'),
+        'zstd': ('.zst', 'application/zstd'),
+    }
     DB_NAME = 'dbname'
 
     def __init__(self):
@@ -85,6 +190,55 @@ class AnalyzeXMLPage(Page):
         super().__init__("analyzexml")
 
 
+    def submit_job(self, name: str, target: str, url: str, *args) -> bool:
+        file_uploaded = args[1]
+        try:
+            job = JobRunner.submit(name, st.session_state.get("secrets.user"), run_import, url, *args,
+                                   total_bytes=os.path.getsize(file_uploaded), target=url, source=file_uploaded)
+        except JobConflict as e:
+            st.sidebar.error(e)
+            return False
+        self.set_session_state(self.JOB, (job.id, target, url))
+        return True
+
+
+    @st.fragment(run_every=1)
+    def show_job(self):
+        job_id, target, url = self.get_session_state(self.JOB)
+        job = JobRunner.get_job(job_id)
+        if job is None:
+            self.del_session_state(self.JOB)
+            return
+
+        status = job.get_status()
+        st.progress(status['progress'], text=f"{job.name}: {job.state} ({status['seconds']} s)")
+        elements, rows, read = st.columns(3)
+        elements.metric("Elements/s", status['elements_per_s'])
+        rows.metric("Rows/s", status['rows_per_s'])
+        read.metric("MB read", round(status['bytes'] / (1 << 20), 1))
+        if status['tables']:
+            st.write(status['tables'])
+        st.caption(f"Seconds per step: {status['times']}, rows waiting: {status['queue']}")
+
+        if job.state not in FINISHED:
+            if st.button("Cancel import", use_container_width=True):
+                JobRunner.cancel(job_id)
+            return
+
+        # The page is drawn again with the results of the finished job
+        self.del_session_state(self.JOB)
+        if job.state == DONE:
+            self.set_session_state(target, url)
+            if target == self.DB_CREATED:
+                self.set_session_state(self.DB_INSERTED, True)
+            if job.result:
+                self.set_session_state(self.IMPORT_STATS, job.result)
+        elif job.state == FAILED:
+            st.error(job.error)
+            return
+        st.rerun()
+
+
     def main(self):
         if not check_password():
             st.stop()
@@ -93,9 +247,29 @@ class AnalyzeXMLPage(Page):
         status_view = st.empty().container()
         st.divider()
 
+        running = self.get_session_state(self.JOB) is not None
+        if running:
+            self.show_job()
+
+        jobs = JobRunner.get_jobs(st.session_state.get("secrets.user"))
+        if jobs:
+            with st.sidebar.expander("Import jobs"):
+                for job in reversed(jobs):
+                    st.write(f"{job.name}: {job.state}")
+
         uploaded = st.sidebar.file_uploader("Choose a XML file", type='xml', accept_multiple_files=False)
-        if uploaded:
-            file_path = save_temp_file(uploaded)
+        file_uploaded = self.get_session_state(self.FILE_UPLOADED)
+        if uploaded and (uploaded.file_id != self.get_session_state(self.UPLOAD_ID)
+                         or not os.path.exists(file_uploaded)):
+            # Spooled once per upload, not on every rerun, and again if it has been evicted since.
+            # The analysis of a file with the same content is kept, another file starts from scratch.
+            file_path, digest = save_temp_file(uploaded, keep=JobRunner.get_sources())
+            if digest != self.get_session_state(self.FILE_HASH):
+                for key in (self.XML_ANALYZED, self.XML_SAMPLED, self.ANALYSIS_KEY, self.UPLOADED_XML, self.CHECKED_NODES,
+                            self.STATEMENTS, self.TABLES):
+                    self.del_session_state(key)
+            self.set_session_state(self.UPLOAD_ID, uploaded.file_id)
+            self.set_session_state(self.FILE_HASH, digest)
             self.set_session_state(self.FILE_UPLOADED, file_path)
         file_uploaded = self.get_session_state(self.FILE_UPLOADED)
 
@@ -104,8 +278,27 @@ class AnalyzeXMLPage(Page):
 
         status_view.checkbox("File uploaded", value=(file_uploaded is not None), disabled=True)
 
+        sample = st.sidebar.checkbox("Sample XML structure", self.get_session_state(self.SAMPLE),
+                                     help="Only analyze the start of the file, the counts are estimated (~)")
+        self.set_session_state(self.SAMPLE, sample)
+        if sample:
+            sample_records = st.sidebar.number_input("Sample records", min_value=1,
+                                                     value=self.get_session_state(self.SAMPLE_RECORDS, 1000))
+            self.set_session_state(self.SAMPLE_RECORDS, sample_records)
+            sample_every = st.sidebar.number_input("Analyze every n-th repeated element", min_value=1,
+                                                   value=self.get_session_state(self.SAMPLE_EVERY, 1))
+            self.set_session_state(self.SAMPLE_EVERY, sample_every)
+
         if st.sidebar.button("Analyze XML strructure", use_container_width=True, disabled=(file_uploaded is None)):
-            struct, checked = analyze_xml_file_structure(file_uploaded, ignore_ns)
+            if sample:
+                sampling = (sample_records, self.SAMPLE_BYTES, sample_every)
+            else:
+                sampling = (None, None, 1)
+            digest = self.get_session_state(self.FILE_HASH)
+            key = digest and ResultCache.get_key(digest, ignore_ns, *sampling)
+            struct, checked = analyze_xml_file_structure(file_uploaded, ignore_ns, *sampling, key)
+            self.set_session_state(self.ANALYSIS_KEY, key)
+            self.set_session_state(self.XML_SAMPLED, sample)
             self.set_session_state(self.XML_ANALYZED, True)
             self.set_session_state(self.UPLOADED_XML, struct)
             self.set_session_state(self.CHECKED_NODES, checked)
@@ -127,20 +320,27 @@ class AnalyzeXMLPage(Page):
 
         if st.sidebar.button("Reset All", use_container_width=True):
             self.del_session_state(self.XML_ANALYZED)
+            self.del_session_state(self.XML_SAMPLED)
+            self.del_session_state(self.ANALYSIS_KEY)
             self.del_session_state(self.UPLOADED_XML)
             self.del_session_state(self.CHECKED_NODES)
             self.del_session_state(self.STATEMENTS)
+            self.del_session_state(self.TABLES)
             self.del_session_state(self.DB_CREATED)
             self.del_session_state(self.DB_INSERTED)
             self.del_session_state(self.SQL_CREATED)
+            self.del_session_state(self.PARQUET_CREATED)
+            self.del_session_state(self.IMPORT_STATS)
             st.rerun()
 
         if st.sidebar.button("Generate SQL create statements", use_container_width=True, disabled=not xml_analyzed):
-            statements = []
-            CreateSQL.search_checked_nodes(struct, checked, statements, full_name)
+            statements, tables = create_statements(struct, checked, full_name,
+                                                   self.get_session_state(self.ANALYSIS_KEY))
             self.set_session_state(self.STATEMENTS, statements)
+            self.set_session_state(self.TABLES, tables)
 
         statements = self.get_session_state(self.STATEMENTS)
+        tables = self.get_session_state(self.TABLES)
         status_view.checkbox("DB structure generated", value=(statements is not None), disabled=True)
 
         if statements:
@@ -150,53 +350,95 @@ class AnalyzeXMLPage(Page):
         dbname = st.sidebar.text_input("Database name:", self.get_session_state(self.DB_NAME, "database"))
         self.set_session_state(self.DB_NAME, dbname)
 
-        if st.sidebar.button("Create SQL Database", use_container_width=True, disabled=(statements is None)):
+        parallel = st.sidebar.checkbox("Parallel import", self.get_session_state(self.PARALLEL))
+        self.set_session_state(self.PARALLEL, parallel)
+
+        incremental = st.sidebar.checkbox("Incremental import", self.get_session_state(self.INCREMENTAL),
+                                          help="Only insert and delete the changed records of an existing database")
+        self.set_session_state(self.INCREMENTAL, incremental)
+
+        lookups = st.sidebar.checkbox("Index lookup fields", self.get_session_state(self.LOOKUPS),
+                                      help="Also index the columns with many distinct values")
+        self.set_session_state(self.LOOKUPS, lookups)
+
+        # The tables of a sample lack the fields and lists it did not see, their values would be
+        # dropped by the import. Only the tables of a full analysis are exported.
+        sampled = self.get_session_state(self.XML_SAMPLED, False)
+        if statements and sampled:
+            st.sidebar.warning("The XML structure was sampled. Analyze the whole file before exporting, "
+                               "fields missing in the sample would be lost.")
+
+        if st.sidebar.button("Create SQL Database", use_container_width=True,
+                             disabled=(statements is None or running or sampled)):
             # dir = tempfile.TemporaryDirectory().name
             dir = os.getenv("DATABASE_DIR")
             os.makedirs(dir, exist_ok=True)
             url = f"sqlite:///{dir}/{dbname}.db"
             print(f'Database file: {url}')
 
-            db = SQLGlobals(url, checked, ignore_ns, full_name)
-
-            create_sql(db, statements)
-            status_view.checkbox("DB structure created", value=True, disabled=True)
+            self.del_session_state(self.IMPORT_STATS)
+            if self.submit_job(f"Database {dbname}", self.DB_CREATED, url, statements, file_uploaded,
+                               checked, ignore_ns, full_name, tables, parallel, incremental, lookups):
+                st.rerun()
 
-            insert_sql(db, file_uploaded)
-            status_view.checkbox("DB data inserted", value=True, disabled=True)
+        status_view.checkbox("DB structure created", disabled=True,
+                             value=(self.get_session_state(self.DB_CREATED) is not None))
+        status_view.checkbox("DB data inserted", disabled=True,
+                             value=(self.get_session_state(self.DB_INSERTED) is not None))
 
-            self.set_session_state(self.DB_CREATED, url)
-            self.set_session_state(self.DB_INSERTED, True)
+        stats = self.get_session_state(self.IMPORT_STATS)
+        if stats:
+            st.sidebar.write(stats)
 
-        else:
-            status_view.checkbox("DB structure created", disabled=True,
-                                 value=(self.get_session_state(self.DB_CREATED) is not None))
-            status_view.checkbox("DB data inserted", disabled=True,
-                                 value=(self.get_session_state(self.DB_INSERTED) is not None))
+        extensions = SQLDumpWriter.get_extensions()
+        compressions = [name for name, (ext, _) in self.COMPRESSIONS.items() if ext in extensions]
+        compression = st.sidebar.selectbox("SQL file compression", options=compressions,
+                                           index=compressions.index(self.get_session_state(self.COMPRESSION, 'none')))
+        self.set_session_state(self.COMPRESSION, compression)
 
-        if statements and st.sidebar.button("Create SQL file", use_container_width=True):
+        if statements and st.sidebar.button("Create SQL file", use_container_width=True,
+                                            disabled=(running or sampled)):
             dir = os.getenv("FILE_DIR")
             os.makedirs(dir, exist_ok=True)
-            url = f"file:///{dir}/{dbname}.sql"
+            url = f"file:///{dir}/{dbname}.sql{self.COMPRESSIONS[compression][0]}"
             print(f'Temporary file: {url}')
 
-            db = SQLGlobals(url, checked, ignore_ns, full_name)
-            create_sql(db, statements)
-            status_view.checkbox("DB structure written", value=True, disabled=True)
-
-            insert_sql(db, file_uploaded)
-            status_view.checkbox("DB data written", value=True, disabled=True)
-
-            self.set_session_state(self.SQL_CREATED, url)
+            if self.submit_job(f"SQL file {dbname}", self.SQL_CREATED, url, statements, file_uploaded,
+                               checked, ignore_ns, full_name, tables, parallel, False, lookups):
+                st.rerun()
 
         sql_file = self.get_session_state(self.SQL_CREATED)
         if sql_file:
-            with open(sql_file[8:]) as f:
-                st.sidebar.download_button('Download SQL file',
-                                            data=f, 
-                                            file_name=f"{dbname}.sql",
-                                            mime='text/sql',
-                                            use_container_width=True)
+            status_view.checkbox("SQL file written", value=True, disabled=True)
+            # The file is only read when the button is clicked, not on every rerun
+            path = sql_file[8:]
+            mime = next((mime for ext, mime in self.COMPRESSIONS.values() if ext and path.endswith(ext)), 'text/sql')
+            st.sidebar.download_button('Download SQL file',
+                                        data=lambda: read_file(path),
+                                        file_name=os.path.basename(path),
+                                        mime=mime,
+                                        use_container_width=True)
+
+        if statements and ArrowWriter.is_available() and \
+                st.sidebar.button("Create Parquet files", use_container_width=True, disabled=(running or sampled)):
+            dir = os.getenv("FILE_DIR")
+            folder = f"{dir}/{dbname}"
+            url = f"parquet:///{folder}"
+            print(f'Parquet folder: {url}')
+
+            if self.submit_job(f"Parquet files {dbname}", self.PARQUET_CREATED, url, None, file_uploaded,
+                               checked, ignore_ns, full_name, tables, parallel):
+                st.rerun()
+
+        parquet_url = self.get_session_state(self.PARQUET_CREATED)
+        parquet_folder = parquet_url[11:] if parquet_url else None
+        if parquet_folder:
+            status_view.checkbox("Parquet files written", value=True, disabled=True)
+            st.sidebar.download_button('Download Parquet files',
+                                        data=lambda: zip_folder(parquet_folder),
+                                        file_name=f"{os.path.basename(parquet_folder)}.zip",
+                                        mime='application/zip',
+                                        use_container_width=True)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 import os
 import glob
-import sqlite3
 import pandas as pd
 import streamlit as st
 from streamlit_extras.app_logo import add_logo
@@ -9,6 +8,7 @@ from dotenv import load_dotenv
 
 from password import check_password
 from pageutil import Page
+from dbutil import ConnectionPool, TablePager
 
 
 load_dotenv()
@@ -21,6 +21,8 @@ with st.sidebar:
 DBNAME = "dbname"
 TABLENAME = "tablename"
 STATEMENT = "statement"
+PAGER = "pager"
+PAGE_SIZES = [50, 100, 500, 1000]
 
 
 @st.experimental_dialog("Confirm your selection")
@@ -36,6 +38,54 @@ class SQLBrowserPage(Page):
         print('Init SQLBrowserPage')
         super().__init__("dbview")
 
+    def get_pager(self, file_name: str, table: str) -> TablePager:
+        # The pager keeps the page keys for the session while the same table is shown
+        pager = self.get_session_state(PAGER)
+        if pager and (pager.path != file_name or pager.table != table):
+            pager = None
+        if pager is None:
+            pager = TablePager(file_name, table)
+            self.set_session_state(PAGER, pager)
+        return pager
+
+
+    @st.fragment(run_every=1)
+    def show_count(self):
+        pager = self.get_session_state(PAGER)
+        if pager.get_count() is None:
+            st.caption("Counting rows...")
+        else:
+            st.rerun()
+
+
+    def browse_table(self, file_name: str, table: str):
+        pager = self.get_pager(file_name, table)
+        # The buttons move the pager in their callbacks, before the page is drawn
+        df = pager.get_page()
+
+        first_page = pager.get_page_number() == 1
+        first, previous, next, size = st.columns([1, 1, 1, 2])
+        first.button("First", use_container_width=True, disabled=first_page, on_click=pager.first)
+        previous.button("Previous", use_container_width=True, disabled=first_page, on_click=pager.previous)
+        next.button("Next", use_container_width=True, disabled=not pager.has_next(), on_click=pager.next)
+        page_size = size.selectbox("Rows per page", options=PAGE_SIZES, index=PAGE_SIZES.index(pager.page_size),
+                                   label_visibility="collapsed")
+        if page_size != pager.page_size:
+            pager.page_size = page_size
+            pager.first()
+            df = pager.get_page()
+
+        st.dataframe(df, use_container_width=True)
+
+        count = pager.get_count()
+        if count is None:
+            st.caption(f"Page {pager.get_page_number()}")
+            self.show_count()
+        else:
+            pages = max((count + pager.page_size - 1) // pager.page_size, 1)
+            st.caption(f"Page {pager.get_page_number()} of {pages}, {count} rows")
+
+
     def main(self):
         if not check_password():
             st.stop()
@@ -51,11 +101,13 @@ class SQLBrowserPage(Page):
         file_name = f'{dir}/{dbname}'
 
         if st.sidebar.button("Delete Database:", use_container_width=True):
+            self.del_session_state(PAGER)
+            ConnectionPool.evict(file_name)
             os.remove(file_name)
             st.rerun()
 
         if dbname:
-            db = sqlite3.connect(file_name)
+            db = ConnectionPool.get_connection(file_name)
             cursor = db.cursor()
             result = cursor.execute("SELECT tbl_name FROM sqlite_master WHERE type='table'").fetchall()
             tables = list(map(lambda x: x[0], result))
@@ -77,6 +129,9 @@ class SQLBrowserPage(Page):
                 self.set_session_state(STATEMENT, stmt)
                 df = pd.read_sql_query(stmt, db)
                 st.dataframe(df, use_container_width=True)
+            elif table:
+                # Without a statement the table is browsed page by page
+                self.browse_table(file_name, table)
             
 
 if __name__ == "__main__":
@@ -1,81 +1,578 @@
+import io
 import os
+import gzip
+import hashlib
 import sqlite3
 import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree import ElementTree
-from langchain_community.utilities import SQLDatabase
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+import sqlalchemy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from util import (
-  get_node_name, get_tag_name, prefix_field_name,
+  get_node_name, get_tag_name, prefix_field_name, CountingReader, XMLParser,
   VALUE, CHILDREN, LABEL
 )
+from xmlutil import TYPE, TEXT, DISTINCT, DISTINCT_LIMIT
+
+# Work items of the iterative tree walks
+WALK_FIELDS = 'fields'
+WALK_CHILD = 'child'
+WALK_TABLE = 'table'
+WALK_END = 'end'
 
 
 class SQLStmt:
+    tablename: str
+    tablepath: str
+    reference: str
     columns: list;
     values: list;
 
-    def __init__(self):
+    def __init__(self, tablename: str = None, tablepath: str = None, reference: str = None):
+        self.tablename = tablename
+        self.tablepath = tablepath
+        self.reference = reference
         self.columns = []
         self.values = []
 
 
+class SQLTable:
+    tablename: str
+    tablepath: str
+    ref_name: str
+    parent: object
+    fixed: bool
+    columns: tuple
+    index: dict
+    fields: dict
+    types: dict
+    indexes: list
+    lookups: list
+
+    def __init__(self,
+                 tablename:    str,
+                 tablename_id: str,
+                 tablepath:    str,
+                 parent:       object = None,
+                 columns:      list = None):
+        # Shape plan of a table: the column layout is fixed when it comes from CreateSQL,
+        # otherwise it is learned from the inserted records
+        self.tablename = tablename
+        self.tablepath = tablepath
+        self.ref_name = f'{tablename_id}_ID'
+        self.parent = parent
+        self.fixed = columns is not None
+        self.columns = ()
+        self.index = {}
+        self.fields = {}
+        self.types = {}
+        self.indexes = []
+        self.lookups = []
+
+        self.add_column(self.ref_name)
+        if parent:
+            self.add_column('REFERENCE_ID')
+            self.indexes.append('REFERENCE_ID')
+        for col in columns or []:
+            self.add_column(col)
+
+    def add_column(self,
+                   column: str) -> int:
+        if column not in self.index:
+            self.index[column] = len(self.columns)
+            self.columns += (column,)
+        return self.index[column]
+
+    def get_column_index(self,
+                         column: str) -> int:
+        idx = self.index.get(column)
+        if idx is None:
+            if self.fixed:
+                print(f'Column "{column}" not in table "{self.tablename}", value ignored')
+                self.index[column] = -1
+                return -1
+            idx = self.add_column(column)
+        return idx
+
+    def get_field(self,
+                  tag:         str,
+                  parent_path: str,
+                  prefix:      str,
+                  db:          object) -> tuple:
+        # Name, path, column and checked state only depend on the parent path and tag,
+        # so they are computed once per distinct element position of the table
+        key = (parent_path, tag)
+        field = self.fields.get(key)
+        if field is None:
+            name, subpath = get_tag_name(tag, parent_path, db.ignore_ns)
+            field = (name, subpath, prefix_field_name(name, prefix), subpath in db.checked)
+            self.fields[key] = field
+        return field
+
+
 class SQLRef:
     statements: list
+    table: SQLTable
     ref: str
     ref_id: int
 
-    def __init__(self, ref: str, ref_id: int):
+    def __init__(self, table: SQLTable, ref_id: int):
         self.statements = []
-        self.ref = ref
+        self.table = table
+        self.ref = table.ref_name
         self.ref_id = ref_id
 
 
+class SQLBatch:
+    tablename: str
+    tablepath: str
+    columns: tuple
+    depth: int
+    rows: list
+
+    def __init__(self, tablename: str, tablepath: str, columns: tuple):
+        self.tablename = tablename
+        self.tablepath = tablepath
+        self.columns = columns
+        self.depth = tablepath.count('/')
+        self.rows = []
+
+    def get_insert(self) -> str:
+        columns = ','.join(f'"{col}"' for col in self.columns)
+        return f'INSERT INTO "{self.tablename}" ({columns}) VALUES '
+
+    def get_sql(self, placeholders: list) -> str:
+        return self.get_insert() + f'({",".join(placeholders)});'
+
+
+class SQLDumpWriter:
+    file: object
+    rows_per_insert: int
+
+    def __init__(self,
+                 path:            str,
+                 rows_per_insert: int = 100,
+                 buffer_size:     int = 1 << 22):
+        # The compression is chosen by the file extension: .gz or .zst
+        if path.endswith('.gz'):
+            raw = gzip.GzipFile(path, 'wb', compresslevel=6)
+        elif path.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError('zstd compression needs the zstandard package')
+            raw = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+        else:
+            raw = open(path, 'wb', buffering=0)
+
+        self.file = io.TextIOWrapper(io.BufferedWriter(raw, buffer_size), encoding='utf-8')
+        self.rows_per_insert = rows_per_insert
+
+    @staticmethod
+    def get_extensions() -> list:
+        return ['', '.gz'] + (['.zst'] if zstandard else [])
+
+    def write(self,
+              text: str):
+        self.file.write(text)
+
+    def run(self,
+            stmt: str):
+        self.file.write(stmt)
+        self.file.write('\n')
+
+    def begin(self):
+        self.file.write('BEGIN TRANSACTION;\n')
+
+    def end(self):
+        self.file.write('END TRANSACTION;\n')
+        self.file.flush()
+
+    def write_batch(self,
+                    batch: object):
+        # Multi-row VALUES lists are much shorter to write and faster to load
+        for i in range(0, len(batch.rows), self.rows_per_insert):
+            rows = batch.rows[i:i + self.rows_per_insert]
+            self.file.write(batch.get_insert())
+            self.file.write(',\n'.join('(' + ','.join(map(SQLGlobals.get_sql_literal, row)) + ')'
+                                       for row in rows))
+            self.file.write(';\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    folder: str
+    tables: dict
+    row_group_size: int
+    schemas: dict
+    pending: dict
+    writers: dict
+
+    ARROW_TYPES = {
+        'INTEGER': 'int64',
+        'REAL': 'float64',
+        'TEXT': 'string',
+    }
+
+    def __init__(self,
+                 folder:         str,
+                 tables:         dict,
+                 row_group_size: int = 1 << 16):
+        # Writes one Parquet file per table, the schema comes from the CreateSQL plans
+        if pyarrow is None:
+            raise ValueError('Parquet export needs the pyarrow package')
+        for table in tables.values():
+            if not table.fixed:
+                raise ValueError('Parquet export needs the table plans from CreateSQL')
+
+        # Files of tables from an earlier export must not be mixed with the new ones
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            if name.endswith('.parquet'):
+                os.remove(os.path.join(folder, name))
+
+        self.folder = folder
+        self.tables = tables
+        self.row_group_size = row_group_size
+        self.schemas = {}
+        self.pending = {}
+        self.writers = {}
+
+    def get_schema(self,
+                   table: SQLTable) -> object:
+        schema = self.schemas.get(table.tablepath)
+        if schema is None:
+            fields = []
+            for col in table.columns:
+                if col in (table.ref_name, 'REFERENCE_ID'):
+                    fields.append(pyarrow.field(col, pyarrow.int64()))
+                else:
+                    fields.append(pyarrow.field(col, self.ARROW_TYPES[table.types.get(col, 'TEXT')]))
+            schema = self.schemas[table.tablepath] = pyarrow.schema(fields)
+        return schema
+
+    @staticmethod
+    def is_available() -> bool:
+        return pyarrow is not None
+
+    @staticmethod
+    def get_number(convert: object,
+                   value:   object) -> object:
+        try:
+            return None if value is None else convert(value)
+        except ValueError:
+            print(f'Value "{value}" is not a number, stored as NULL')
+            return None
+
+    def run(self,
+            stmt: str):
+        # The SQL statements have no meaning for Parquet files
+        pass
+
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+    def write_batch(self,
+                    batch: object):
+        table = self.tables[batch.tablepath]
+        schema = self.get_schema(table)
+        arrays = []
+        for field, values in zip(schema, zip(*batch.rows)):
+            if pyarrow.types.is_integer(field.type):
+                values = [ArrowWriter.get_number(int, v) for v in values]
+            elif pyarrow.types.is_floating(field.type):
+                values = [ArrowWriter.get_number(float, v) for v in values]
+            arrays.append(pyarrow.array(values, field.type))
+
+        # Small record batches are collected, every write creates a Parquet row group
+        pending = self.pending.setdefault(batch.tablepath, [])
+        pending.append(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+        if sum(len(b) for b in pending) >= self.row_group_size:
+            self.write_table(table)
+
+    def write_table(self,
+                    table: SQLTable):
+        pending = self.pending.pop(table.tablepath, None)
+        if not pending:
+            return
+
+        writer = self.writers.get(table.tablepath)
+        if writer is None:
+            path = os.path.join(self.folder, f'{table.tablename.replace("/", ".")}.parquet')
+            writer = pyarrow.parquet.ParquetWriter(path, self.get_schema(table))
+            self.writers[table.tablepath] = writer
+        writer.write_table(pyarrow.Table.from_batches(pending))
+
+    def close(self):
+        for table in self.tables.values():
+            self.write_table(table)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+class SQLEngineWriter:
+    engine: object
+    connection: object
+    transaction: object
+    commit_size: int
+    uncommitted: int
+
+    # Engines and their connection pools are shared by all imports into the same database
+    engines = {}
+
+    def __init__(self,
+                 uri:         str,
+                 pool_size:   int = 5,
+                 commit_size: int = 100000):
+        self.engine = SQLEngineWriter.engines.get(uri)
+        if self.engine is None:
+            self.engine = sqlalchemy.create_engine(uri, pool_size=pool_size, pool_pre_ping=True)
+            SQLEngineWriter.engines[uri] = self.engine
+
+        print("DB dialect: " + self.engine.dialect.name)
+        self.connection = None
+        self.transaction = None
+        self.commit_size = commit_size
+        self.uncommitted = 0
+
+    def run(self,
+            stmt: str):
+        if self.connection is None:
+            with self.engine.begin() as connection:
+                connection.exec_driver_sql(stmt)
+        else:
+            self.connection.exec_driver_sql(stmt)
+
+    def begin(self):
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        self.uncommitted = 0
+
+    def end(self):
+        if self.connection is not None:
+            self.transaction.commit()
+            self.connection.close()
+            self.connection = None
+            self.transaction = None
+
+    def commit(self):
+        # Large imports are split into transactions of commit_size rows
+        self.transaction.commit()
+        self.transaction = self.connection.begin()
+        self.uncommitted = 0
+
+    @staticmethod
+    def get_csv_value(value) -> str:
+        if value is None:
+            return ''
+        if isinstance(value, (int, float)):
+            return str(value)
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def copy_batch(self,
+                   batch: object) -> bool:
+        # PostgreSQL loads CSV through COPY much faster than through INSERT statements
+        cursor = self.connection.connection.dbapi_connection.cursor()
+        columns = ','.join(f'"{col}"' for col in batch.columns)
+        sql = f'COPY "{batch.tablename}" ({columns}) FROM STDIN WITH (FORMAT csv)'
+        data = ''.join(','.join(map(SQLEngineWriter.get_csv_value, row)) + '\n' for row in batch.rows)
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(sql, io.StringIO(data))
+            elif hasattr(cursor, 'copy'):
+                with cursor.copy(sql) as copy:
+                    copy.write(data)
+            else:
+                return False
+        finally:
+            cursor.close()
+        return True
+
+    def write_batch(self,
+                    batch: object):
+        if self.connection is None:
+            self.begin()
+
+        if self.engine.dialect.name != 'postgresql' or not self.copy_batch(batch):
+            # executemany of a Core insert, SQLAlchemy turns it into multi-row VALUES
+            # or the driver's own batch mode depending on the dialect
+            table = sqlalchemy.table(batch.tablename, *map(sqlalchemy.column, batch.columns))
+            self.connection.execute(table.insert(), [dict(zip(batch.columns, row)) for row in batch.rows])
+
+        self.uncommitted += len(batch.rows)
+        if self.uncommitted >= self.commit_size:
+            self.commit()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.end()
+
+
 class SQLGlobals:
     db: object
-    checked: list
+    checked: set
+    tables: dict
     ids: dict
     ignore_ns: bool
     full_name: bool
+    batch_size: int
+    batches: dict
+    pending: int
+    progress: object
 
     def __init__(self,
-                 db:        object,
-                 checked:   list,
-                 ignore_ns: bool,
-                 full_name: bool,
-                 ids:       dict = dict()):
+                 db:         object,
+                 checked:    list,
+                 ignore_ns:  bool,
+                 full_name:  bool,
+                 ids:        dict = None,
+                 batch_size: int = 1000,
+                 tables:     dict = None):
+        self.checked = set(checked)
+        self.tables = dict(tables) if tables else {}
+
         if db and db.startswith('file:///'):
-            self.db = open(db[8:], "w")
+            self.db = SQLDumpWriter(db[8:])
+        elif db.startswith('parquet:///'):
+            self.db = ArrowWriter(db[11:], self.tables)
         elif db.startswith('sqlite:///'):
             self.db = sqlite3.connect(db[10:])
         else:
-            self.db = SQLDatabase.from_uri(db)
-            print("DB dialect: " + self.db.dialect)
+            self.db = SQLEngineWriter(db)
 
         print('Use Database: ' + str(type(self.db)))
-
-        self.checked = checked
         self.ignore_ns = ignore_ns
         self.full_name = full_name
-        self.ids = ids
+        self.ids = ids if ids is not None else {}
+        self.batch_size = batch_size
+        self.batches = {}
+        self.pending = 0
+
+        # Optional metricsutil.ImportMetrics of the import, a jobutil.Job also
+        # cancels the import by raising from update
+        self.progress = None
+
+    @staticmethod
+    def get_sql_literal(value) -> str:
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (int, float)):
+            return str(value)
+        return "'" + str(value).replace("'", "''") + "'"
 
     def run(self,
             stmt: str):
+        self.flush()
         if isinstance(self.db, sqlite3.Connection):
             try:
                 self.db.execute(stmt)
             except:
                 print(f'Last SQL: {stmt}')
                 raise
-        elif isinstance(self.db, SQLDatabase):
+        else:
             try:
                 self.db.run(stmt)
             except:
                 print(f'Last SQL: {stmt}')
                 raise
+
+    def get_table(self,
+                  tablename:    str,
+                  tablename_id: str,
+                  tablepath:    str,
+                  parent:       SQLTable = None) -> SQLTable:
+        table = self.tables.get(tablepath)
+        if table is None:
+            table = SQLTable(tablename, tablename_id, tablepath, parent)
+            self.tables[tablepath] = table
+        return table
+
+    def insert(self,
+               stmt: SQLStmt):
+        self.insert_row(stmt.tablename, stmt.tablepath, stmt.columns, stmt.values)
+
+    def insert_row(self,
+                   tablename: str,
+                   tablepath: str,
+                   columns:   tuple,
+                   values:    list):
+        # Rows are grouped per table and column signature and written with executemany
+        key = (tablename, columns)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = SQLBatch(tablename, tablepath, columns)
+            self.batches[key] = batch
+
+        batch.rows.append(values)
+        self.pending += 1
+        if len(batch.rows) >= self.batch_size:
+            self.flush()
+
+    def run_batch(self,
+                  batch: SQLBatch):
+        progress = self.progress
+        if progress:
+            progress.add_rows(batch.tablename, len(batch.rows))
+            progress.enter('sql')
+
+        if isinstance(self.db, sqlite3.Connection):
+            sql = batch.get_sql(['?'] * len(batch.columns))
+            try:
+                self.db.executemany(sql, batch.rows)
+            except:
+                print(f'Last SQL: {sql}')
+                raise
         else:
-            # print(stmt)
-            self.db.write(stmt)
-            self.db.write('\n')
+            try:
+                self.db.write_batch(batch)
+            except:
+                print(f'Last SQL: {batch.get_insert()}...')
+                raise
+
+        if progress:
+            progress.leave('sql')
+
+    def flush(self):
+        # Parent tables have shorter paths than the tables referencing them, so writing
+        # the batches ordered by depth keeps the foreign keys valid
+        if self.batches:
+            batches = sorted(self.batches.values(), key=lambda batch: batch.depth)
+            self.batches = {}
+            self.pending = 0
+            for batch in batches:
+                self.run_batch(batch)
+
+    def create_indexes(self,
+                       lookups: bool = False):
+        # Created after the data is inserted, which is faster than updating them per row
+        for table in self.tables.values():
+            for col in table.indexes + (table.lookups if lookups else []):
+                self.run(f'CREATE INDEX IF NOT EXISTS "IDX_{table.tablename}_{col}" '
+                         f'ON "{table.tablename}" ("{col}");')
 
     def begin(self):
         if isinstance(self.db, sqlite3.Connection):
@@ -85,28 +582,61 @@ class SQLGlobals:
             except:
                 print(f'Last SQL: BEGIN TRANSACTION')
                 raise
-        elif isinstance(self.db, SQLDatabase):
-            pass
         else:
-            self.db.write('BEGIN TRANSACTION;\n')
+            self.db.begin()
 
     def end(self):
+        self.flush()
         if isinstance(self.db, sqlite3.Connection):
             try:
                 self.db.execute('END TRANSACTION;')
             except:
                 print(f'Last SQL: END TRANSACTION')
                 raise
-        elif isinstance(self.db, SQLDatabase):
-            pass
-            # try:
-            #     self.db.run('END TRANSACTION;')
-            # except:
-            #     print(f'Last SQL: commit')
-            #     raise
         else:
-            self.db.write('END TRANSACTION;\n')
-            self.db.flush()
+            self.db.end()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class SQLCollector(SQLGlobals):
+    statements: list
+
+    def __init__(self,
+                 checked:   list,
+                 ignore_ns: bool,
+                 full_name: bool,
+                 tables:    dict = None):
+        # Keeps the rows in memory instead of writing them, used by the import workers
+        self.db = None
+        self.checked = set(checked)
+        self.tables = dict(tables) if tables else {}
+        self.ignore_ns = ignore_ns
+        self.full_name = full_name
+        self.ids = {}
+        self.batches = {}
+        self.pending = 0
+        self.progress = None
+        self.statements = []
+
+    def run(self,
+            stmt: str):
+        pass
+
+    def insert(self,
+               stmt: SQLStmt):
+        # Plain tuples are much cheaper to send back from a worker than SQLStmt objects
+        self.statements.append((stmt.tablename, stmt.tablepath, stmt.reference, stmt.columns,
+                                stmt.values))
+
+    def flush(self):
+        pass
+
+
+# Collector of the current import worker process, see InsertSQL.init_worker
+worker_db: SQLCollector = None
 
 
 class CreateSQL:
@@ -131,17 +661,11 @@ class CreateSQL:
                           statements:  list,
                           prefix:      str,
                           full_name:   bool,
-                          foreign_key: str):
-        if CHILDREN in node:
-            for child in node[CHILDREN]:
-                field = prefix_field_name(CreateSQL.get_clean_name(child), prefix)
-                columns.append(field)
-
-                if child[VALUE] in checked:
-                    CreateSQL.create_sql_table(child, checked, statements, full_name, foreign_key)
-                else:
-                    CreateSQL.create_sql_fields(child, columns, checked, statements, field + '.',
-                                                full_name, foreign_key)
+                          foreign_key: str,
+                          tables:      dict = None,
+                          table:       SQLTable = None):
+        CreateSQL.walk_sql_nodes([(WALK_FIELDS, node, columns, prefix, foreign_key, table)],
+                                 checked, statements, full_name, tables)
 
 
     @staticmethod
@@ -149,50 +673,120 @@ class CreateSQL:
                          checked:     list,
                          statements:  list,
                          full_name:   bool,
-                         foreign_key: str = None):
-        tablename, tablename_id = CreateSQL.get_table_name(node, full_name)
+                         foreign_key: str = None,
+                         tables:      dict = None,
+                         parent:      SQLTable = None):
+        CreateSQL.walk_sql_nodes([(WALK_TABLE, node, foreign_key, parent)],
+                                 checked, statements, full_name, tables)
 
-        statements.append(f'DROP TABLE IF EXISTS "{tablename}";')
 
-        index = len(statements)
+    @staticmethod
+    def walk_sql_nodes(stack:      list,
+                       checked:    list,
+                       statements: list,
+                       full_name:  bool,
+                       tables:     dict = None):
+        # Explicit stack instead of recursion, the nodes are visited in the same order.
+        # A table reserves its statements when it is reached and fills in the CREATE
+        # statement after all its columns have been collected.
+        while stack:
+            item = stack.pop()
+            kind = item[0]
 
-        sql = f'CREATE TABLE "{tablename}" ('
-        sql += '\n\t"' + tablename_id + '_ID" INTEGER PRIMARY KEY' # AUTOINCREMENT
+            if kind == WALK_FIELDS:
+                _, node, columns, prefix, foreign_key, table = item
+                if CHILDREN in node:
+                    stack.extend((WALK_CHILD, child, columns, prefix, foreign_key, table)
+                                 for child in reversed(node[CHILDREN]))
 
-        my_foreign_key = f'\t"REFERENCE_ID" INTEGER,\n\tFOREIGN KEY ("REFERENCE_ID") REFERENCES "{tablename}"("{tablename_id}_ID")'
+            elif kind == WALK_CHILD:
+                _, child, columns, prefix, foreign_key, table = item
+                field = prefix_field_name(CreateSQL.get_clean_name(child), prefix)
+                columns.append(field)
+                if table:
+                    table.types[field] = child.get(TYPE, TEXT)
+                    if child.get(DISTINCT, 0) >= DISTINCT_LIMIT:
+                        table.lookups.append(field)
 
-        columns = []
-        CreateSQL.create_sql_fields(node, columns, checked, statements, "", full_name,
-                                    my_foreign_key)
+                if child[VALUE] in checked:
+                    stack.append((WALK_TABLE, child, foreign_key, table))
+                else:
+                    stack.append((WALK_FIELDS, child, columns, field + '.', foreign_key, table))
 
-        if len(columns) > 0:
-            for col in columns:
-                sql += f',\n\t"{col}" TEXT'
-        else:
-            sql += ',\n\t"VALUE" TEXT'
+            elif kind == WALK_TABLE:
+                _, node, foreign_key, parent = item
+                tablename, tablename_id = CreateSQL.get_table_name(node, full_name)
+                table = SQLTable(tablename, tablename_id, node[VALUE], parent, [])
+
+                statements.append(f'DROP TABLE IF EXISTS "{tablename}";')
+                statements.append(None)
+                index = len(statements) - 1
+
+                my_foreign_key = f'\t"REFERENCE_ID" INTEGER,\n\tFOREIGN KEY ("REFERENCE_ID") REFERENCES "{tablename}"("{tablename_id}_ID")'
+
+                columns = []
+                stack.append((WALK_END, node, columns, foreign_key, table, index))
+                stack.append((WALK_FIELDS, node, columns, "", my_foreign_key, table))
+
+            else:
+                _, node, columns, foreign_key, table, index = item
+
+                sql = f'CREATE TABLE "{table.tablename}" ('
+                sql += '\n\t"' + table.ref_name + '" INTEGER PRIMARY KEY' # AUTOINCREMENT
+
+                if len(columns) < 1:
+                    columns.append('VALUE')
+                    table.types['VALUE'] = node.get(TYPE, TEXT)
+
+                for col in columns:
+                    sql += f',\n\t"{col}" {table.types[col]}'
+                    table.add_column(col)
+
+                if tables is not None:
+                    tables[node[VALUE]] = table
 
-        if foreign_key:
-            sql += ',\n' + foreign_key
+                if foreign_key:
+                    sql += ',\n' + foreign_key
 
-        sql += "\n);\n"
-        statements.insert(index, sql)
+                sql += "\n);\n"
+                statements[index] = sql
 
 
     @staticmethod
     def search_checked_nodes(node:       dict,
                              checked:    list,
                              statements: list,
-                             full_name:  bool):
-        value = node[VALUE]
-        if value in checked:
-            CreateSQL.create_sql_table(node, checked, statements, full_name)
-        elif CHILDREN in node:
-            for child in node[CHILDREN]:
-                CreateSQL.search_checked_nodes(child, checked, statements, full_name)
+                             full_name:  bool,
+                             tables:     dict = None):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node[VALUE] in checked:
+                CreateSQL.create_sql_table(node, checked, statements, full_name, None, tables)
+            elif CHILDREN in node:
+                stack.extend(reversed(node[CHILDREN]))
 
 
 class InsertSQL:
 
+    @staticmethod
+    def set_field_value(table:  SQLTable,
+                        stmt:   SQLStmt,
+                        field:  str,
+                        value:  str):
+        idx = table.get_column_index(field)
+        if idx < 0:
+            return
+
+        values = stmt.values
+        if idx >= len(values):
+            values.extend([None] * (idx + 1 - len(values)))
+
+        # Like a repeated column in an INSERT, the first value wins
+        if values[idx] is None:
+            values[idx] = value
+
+
     @staticmethod
     def insert_sql_fields(node:        ElementTree,
                           parent_path: str,
@@ -200,27 +794,7 @@ class InsertSQL:
                           db:          SQLGlobals,
                           stmt:        SQLStmt,
                           ref:         SQLRef):
-        for attrib, text in node.items():
-            value = None if text is None else text.strip()
-            if value:
-                name, subpath = get_tag_name(attrib, parent_path, db.ignore_ns)
-                field = prefix_field_name(name, prefix)
-                stmt.columns.append(field)
-                stmt.values.append(value)
-
-        for child in node:
-            name, subpath = get_node_name(child, parent_path, db.ignore_ns)
-            field = prefix_field_name(name, prefix)
-            value = None if child.text is None else child.text.strip()
-            if value:
-                if len(value) > 0:
-                    stmt.columns.append(field)
-                    stmt.values.append(value)
-
-            if subpath in db.checked:
-                InsertSQL.insert_sql_table(child, name, subpath, db, ref)
-            else:
-                InsertSQL.insert_sql_fields(child, subpath, field + '.', db, stmt, ref)
+        InsertSQL.walk_sql_rows([(WALK_FIELDS, node, parent_path, prefix, stmt, ref)], db, ref.statements)
 
 
     @staticmethod
@@ -229,67 +803,539 @@ class InsertSQL:
                          tablepath:   str,
                          db:          SQLGlobals,
                          parent_ref:  SQLRef = None):
+        rows = []
+        InsertSQL.walk_sql_rows([(WALK_TABLE, node, tablename, tablepath, parent_ref)], db, rows)
 
-        # print(f'Check {parent_path}')
-        tablename_id = tablename
-        if db.full_name:
-            tablename = tablepath
+        # We must insert the main table before the tables that reference to it
+        if parent_ref:
+            parent_ref.statements.extend(rows)
 
-        ref_name = f'"{tablename_id}_ID"'
-        ref_id = db.ids.get(ref_name, 0) + 1
-        db.ids[ref_name] = ref_id
+        else:
+            for stmt in rows:
+                db.insert(stmt)
 
-        ref = SQLRef(ref_name, ref_id)
-        stmt = SQLStmt()
 
-        InsertSQL.insert_sql_fields(node, tablepath, "", db, stmt, ref)
+    @staticmethod
+    def walk_sql_rows(stack: list,
+                      db:    SQLGlobals,
+                      rows:  list):
+        # Explicit stack instead of recursion, the elements are visited in document order.
+        # A table gets its ID and its place in rows when it is reached, so every row
+        # precedes the rows that reference to it, and is completed after all its fields.
+        while stack:
+            item = stack.pop()
+            kind = item[0]
 
-        sql = f'INSERT INTO "{tablename}" ({ref_name}'
+            if kind == WALK_FIELDS:
+                _, node, parent_path, prefix, stmt, ref = item
+                table = ref.table
+                for attrib, text in node.items():
+                    value = None if text is None else text.strip()
+                    if value:
+                        name, subpath, field, checked = table.get_field(attrib, parent_path, prefix, db)
+                        InsertSQL.set_field_value(table, stmt, field, value)
 
-        if parent_ref:
-            sql += ',REFERENCE_ID'# + parent_ref.ref
+                if len(node):
+                    stack.extend((WALK_CHILD, child, parent_path, prefix, stmt, ref) for child in node[::-1])
 
-        for col in stmt.columns:
-            sql += f',"{col}"'
+            elif kind == WALK_CHILD:
+                _, child, parent_path, prefix, stmt, ref = item
+                table = ref.table
+                name, subpath, field, checked = table.get_field(child.tag, parent_path, prefix, db)
+                value = None if child.text is None else child.text.strip()
+                if value:
+                    InsertSQL.set_field_value(table, stmt, field, value)
 
-        value = None if node.text is None else node.text.strip()
+                if checked:
+                    stack.append((WALK_TABLE, child, name, subpath, ref))
+                else:
+                    stack.append((WALK_FIELDS, child, subpath, field + '.', stmt, ref))
 
-        if len(stmt.columns) < 1 and value:
-            sql += ',"VALUE"'
+            elif kind == WALK_TABLE:
+                _, node, tablename, tablepath, parent_ref = item
 
-        sql += f') VALUES ({ref_id}'
+                # print(f'Check {parent_path}')
+                tablename_id = tablename
+                if db.full_name:
+                    tablename = tablepath
 
-        if parent_ref:
-            sql += f',{parent_ref.ref_id}'
+                table = db.get_table(tablename, tablename_id, tablepath,
+                                     parent_ref.table if parent_ref else None)
 
-        for v in stmt.values:
-            val = v.replace('"', '&quot;')
-            sql += f',"{val}"'
+                ref_id = db.ids.get(table.ref_name, 0) + 1
+                db.ids[table.ref_name] = ref_id
 
-        if len(stmt.values) < 1 and value:
-            v = value.replace('"', '&quot;')
-            sql += f',"{v}"'
+                ref = SQLRef(table, ref_id)
 
-        sql += ');'
-        
-        # We must insert the main table before the tables that reference to it
-        if parent_ref:
-            parent_ref.statements.append(sql)
-            parent_ref.statements.extend(ref.statements)
+                stmt = SQLStmt(table.tablename, tablepath, parent_ref.ref if parent_ref else None)
+                stmt.values = [None] * len(table.columns)
+                stmt.values[0] = ref_id
+                id_columns = 1
+
+                if parent_ref:
+                    stmt.values[1] = parent_ref.ref_id
+                    id_columns = 2
+
+                rows.append(stmt)
+                stack.append((WALK_END, node, stmt, ref, id_columns))
+                stack.append((WALK_FIELDS, node, tablepath, "", stmt, ref))
+
+            else:
+                _, node, stmt, ref, id_columns = item
+                table = ref.table
+                value = None if node.text is None else node.text.strip()
+
+                if value and all(v is None for v in stmt.values[id_columns:]):
+                    InsertSQL.set_field_value(table, stmt, 'VALUE', value)
+
+                # The layout may have grown while a learned table collected its fields
+                stmt.values.extend([None] * (len(table.columns) - len(stmt.values)))
+                stmt.columns = table.columns
 
-        else:
-            db.run(sql)
-            for stmt in ref.statements:
-                db.run(stmt)
 
     @staticmethod
     def search_checked_nodes(node:        ElementTree,
                              parent_path: str,
                              db:          SQLGlobals,
                              parent_ref:  SQLRef = None):
-        name, subpath = get_node_name(node, parent_path, db.ignore_ns)
-        if subpath in db.checked:
-            InsertSQL.insert_sql_table(node, name, subpath, db, parent_ref)
-        else:
-            for child in node:
-                InsertSQL.search_checked_nodes(child, subpath, db, parent_ref)
+        stack = [(node, parent_path)]
+        while stack:
+            node, parent_path = stack.pop()
+            name, subpath = get_node_name(node, parent_path, db.ignore_ns)
+            if subpath in db.checked:
+                InsertSQL.insert_sql_table(node, name, subpath, db, parent_ref)
+            else:
+                stack.extend((child, subpath) for child in node[::-1])
+
+
+    @staticmethod
+    def iter_checked_records(source: str,
+                             db:     SQLGlobals):
+        # Yields every outermost checked subtree as soon as its end tag arrives. Finished
+        # records and everything outside of them are cleared and dropped from the parent,
+        # so only the open elements and the current record are kept in memory.
+        stack = []
+        record = 0
+        elements = 0
+        progress = db.progress
+        reader = CountingReader(source)
+        try:
+            if progress:
+                progress.enter('parse')
+            for event, elem in XMLParser.iterparse(reader):
+                if event == 'start':
+                    elements += 1
+                    if record:
+                        stack.append((elem, None, None))
+                        continue
+
+                    parent_path = stack[-1][2] if stack else ""
+                    name, subpath = get_node_name(elem, parent_path, db.ignore_ns)
+                    stack.append((elem, name, subpath))
+                    if subpath in db.checked:
+                        record = len(stack)
+
+                else:
+                    _, name, subpath = stack.pop()
+                    if record:
+                        if len(stack) >= record:
+                            continue
+                        if progress:
+                            progress.leave('parse')
+                            progress.update(reader.count, elements, db.pending)
+                        yield elem, name, subpath
+                        if progress:
+                            progress.enter('parse')
+                        record = 0
+
+                    elem.clear()
+                    if stack:
+                        stack[-1][0].remove(elem)
+        finally:
+            if progress:
+                progress.leave('parse')
+            reader.close()
+
+
+    @staticmethod
+    def stream_checked_nodes(source: str,
+                             db:     SQLGlobals):
+        # Rows of a checked subtree are inserted as soon as its end tag arrives
+        progress = db.progress
+        for elem, name, subpath in InsertSQL.iter_checked_records(source, db):
+            if progress:
+                progress.enter('build')
+            InsertSQL.insert_sql_table(elem, name, subpath, db)
+            if progress:
+                progress.leave('build')
+
+
+    @staticmethod
+    def split_checked_records(source:     str,
+                              db:         SQLGlobals,
+                              block_size: int = 1 << 20):
+        # Finds the byte ranges of the outermost checked subtrees with a bare expat pass,
+        # no elements are built. A range ends where the next tag starts, so it may carry
+        # some trailing text, a record still open at the end of the document like a checked
+        # root ends with the file. Yields (name, subpath, start, end, namespaces) tuples.
+        parser = expat.ParserCreate(namespace_separator='}')
+        stack = []
+        scopes = [()]
+        declared = []
+        records = []
+        record = None
+        depth = 0
+        elements = 0
+
+        def close_record(end: int = None):
+            nonlocal record
+            name, subpath, start, namespaces = record
+            end = parser.CurrentByteIndex if end is None else end
+            records.append((name, subpath, start, end, namespaces))
+            record = None
+
+        def start_namespace(prefix, uri):
+            declared.append((prefix or '', uri))
+
+        def start_element(name, attrs):
+            nonlocal record, depth, elements
+            elements += 1
+            if depth:
+                depth += 1
+                declared.clear()
+                return
+            if record:
+                close_record()
+
+            namespaces = scopes[-1]
+            if declared:
+                namespaces = dict(namespaces)
+                namespaces.update(declared)
+                namespaces = tuple(namespaces.items())
+                declared.clear()
+
+            tag = '{' + name if '}' in name else name
+            name, subpath = get_tag_name(tag, stack[-1] if stack else "", db.ignore_ns)
+            if subpath in db.checked:
+                record = (name, subpath, parser.CurrentByteIndex, scopes[-1])
+                depth = 1
+            else:
+                stack.append(subpath)
+                scopes.append(namespaces)
+
+        def end_element(name):
+            nonlocal depth
+            if depth:
+                depth -= 1
+                return
+            if record:
+                close_record()
+            stack.pop()
+            scopes.pop()
+
+        parser.StartNamespaceDeclHandler = start_namespace
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+
+        progress = db.progress
+        with open(source, 'rb') as f:
+            while True:
+                if progress:
+                    progress.enter('parse')
+                block = f.read(block_size)
+                parser.Parse(block, not block)
+                if progress:
+                    progress.leave('parse')
+                    progress.update(f.tell(), elements, db.pending)
+                if not block and record:
+                    # Only comments, processing instructions and whitespace may follow it
+                    close_record(f.tell())
+                yield from records
+                records.clear()
+                if not block:
+                    break
+
+
+    @staticmethod
+    def init_worker(checked:   list,
+                    ignore_ns: bool,
+                    full_name: bool,
+                    tables:    dict):
+        global worker_db
+        worker_db = SQLCollector(checked, ignore_ns, full_name, tables)
+
+
+    @staticmethod
+    def convert_records(source:   str,
+                        encoding: str,
+                        records:  list) -> {list, dict}:
+        # Runs in a worker process: IDs start at 1 for every chunk and are shifted
+        # by the writer, which knows how many rows the previous chunks produced
+        db = worker_db
+        db.ids = {}
+        db.statements = []
+        with open(source, 'rb') as f:
+            for name, subpath, start, end, namespaces in records:
+                f.seek(start)
+                data = f.read(end - start)
+                # The namespaces declared on the ancestors are declared again on a wrapper
+                decl = ''.join(f' xmlns:{prefix}={quoteattr(uri)}' if prefix else f' xmlns={quoteattr(uri)}'
+                               for prefix, uri in namespaces)
+                head = f'<?xml version="1.0" encoding="{encoding}"?><record{decl}>'
+                root = XMLParser.fromstring(head.encode(encoding) + data + '</record>'.encode(encoding))
+                InsertSQL.insert_sql_table(root[0], name, subpath, db)
+
+        return db.statements, db.ids
+
+
+    @staticmethod
+    def merge_records(db:         SQLGlobals,
+                      statements: list,
+                      ids:        dict):
+        offsets = db.ids
+        for tablename, tablepath, reference, columns, values in statements:
+            values[0] += offsets.get(columns[0], 0)
+            if reference:
+                values[1] += offsets.get(reference, 0)
+            db.insert_row(tablename, tablepath, columns, values)
+
+        for ref_name, count in ids.items():
+            offsets[ref_name] = offsets.get(ref_name, 0) + count
+
+
+    @staticmethod
+    def merge_chunk(db:     SQLGlobals,
+                    future: object):
+        # The rows are built by the workers, here the time is spent waiting for them
+        progress = db.progress
+        if progress:
+            progress.enter('wait')
+        statements, ids = future.result()
+        if progress:
+            progress.leave('wait')
+            progress.enter('build')
+        InsertSQL.merge_records(db, statements, ids)
+        if progress:
+            progress.leave('build')
+
+
+    @staticmethod
+    def get_xml_encoding(source: str) -> str:
+        encoding = 'utf-8'
+
+        def xml_decl(version, enc, standalone):
+            nonlocal encoding
+            encoding = enc or encoding
+
+        parser = expat.ParserCreate()
+        parser.XmlDeclHandler = xml_decl
+        with open(source, 'rb') as f:
+            try:
+                parser.Parse(f.read(1024), False)
+            except expat.ExpatError:
+                pass
+        return encoding
+
+
+    @staticmethod
+    def has_internal_subset(source:     str,
+                            block_size: int = 1 << 16) -> bool:
+        # Reads the prolog up to the doctype or the root element. The entities declared by an
+        # internal DTD subset are only known to a parser that has seen it, a record parsed on
+        # its own by a worker can't resolve them.
+        found = None
+
+        def start_doctype(name, sysid, pubid, has_internal_subset):
+            nonlocal found
+            found = bool(has_internal_subset)
+
+        def start_element(name, attrs):
+            nonlocal found
+            if found is None:
+                found = False
+
+        parser = expat.ParserCreate()
+        parser.StartDoctypeDeclHandler = start_doctype
+        parser.StartElementHandler = start_element
+        with open(source, 'rb') as f:
+            while found is None:
+                block = f.read(block_size)
+                try:
+                    parser.Parse(block, not block)
+                except expat.ExpatError:
+                    break
+                if not block:
+                    break
+        return bool(found)
+
+
+    @staticmethod
+    def parallel_checked_nodes(source:     str,
+                               db:         SQLGlobals,
+                               workers:    int = None,
+                               chunk_size: int = 500):
+        # This process only finds the byte ranges of the records, a pool of worker
+        # processes reads and converts them to rows. Chunks are merged in document order
+        # through the single writer db, so the _ID values match a sequential import.
+        if InsertSQL.has_internal_subset(source):
+            print(f'{source} has an internal DTD subset, it is imported sequentially')
+            InsertSQL.stream_checked_nodes(source, db)
+            return
+
+        workers = workers or os.cpu_count()
+        encoding = InsertSQL.get_xml_encoding(source)
+        context = multiprocessing.get_context('spawn')
+        tables = {path: table for path, table in db.tables.items() if table.fixed}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=InsertSQL.init_worker,
+                                 initargs=(db.checked, db.ignore_ns, db.full_name, tables)) as pool:
+            pending = deque()
+            records = []
+            for record in InsertSQL.split_checked_records(source, db):
+                records.append(record)
+                if len(records) >= chunk_size:
+                    pending.append(pool.submit(InsertSQL.convert_records, source, encoding, records))
+                    records = []
+                    if len(pending) >= 2 * workers:
+                        InsertSQL.merge_chunk(db, pending.popleft())
+
+            if records:
+                pending.append(pool.submit(InsertSQL.convert_records, source, encoding, records))
+
+            while pending:
+                InsertSQL.merge_chunk(db, pending.popleft())
+
+
+class IncrementalSQL:
+
+    INDEX_TABLE = '_IMPORT_INDEX'
+    SCHEMA_TABLE = '_IMPORT_SCHEMA'
+    DELETE_TABLE = '_IMPORT_DELETE'
+    INDEX_COLUMNS = ('TABLENAME', 'HASH', 'ID')
+
+    @staticmethod
+    def get_schema_hash(db:         SQLGlobals,
+                        statements: list) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{db.ignore_ns} {db.full_name}\n'.encode())
+        for stmt in statements:
+            digest.update(stmt.encode())
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def get_record_hash(node: ElementTree) -> str:
+        # The tail is the text after the record, it is not part of the content
+        tail = node.tail
+        node.tail = None
+        data = XMLParser.tostring(node)
+        node.tail = tail
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+    @staticmethod
+    def create_sql(db:         SQLGlobals,
+                   statements: list) -> bool:
+        # Keeps the existing tables when they were created by the same statements,
+        # otherwise the tables and the index are created from scratch.
+        # Returns True if the existing data is kept.
+        if not isinstance(db.db, sqlite3.Connection):
+            raise ValueError('Incremental import needs a sqlite database')
+        if not db.tables:
+            raise ValueError('Incremental import needs the table plans from CreateSQL')
+
+        schema_hash = IncrementalSQL.get_schema_hash(db, statements)
+        db.run(f'CREATE TABLE IF NOT EXISTS "{IncrementalSQL.SCHEMA_TABLE}" ("HASH" TEXT);')
+        row = db.db.execute(f'SELECT "HASH" FROM "{IncrementalSQL.SCHEMA_TABLE}"').fetchone()
+        if row and row[0] == schema_hash:
+            return True
+
+        for stmt in statements:
+            db.run(stmt)
+
+        db.run(f'DROP TABLE IF EXISTS "{IncrementalSQL.INDEX_TABLE}";')
+        db.run(f'CREATE TABLE "{IncrementalSQL.INDEX_TABLE}" ("TABLENAME" TEXT, "HASH" TEXT, "ID" INTEGER);')
+        db.run(f'CREATE INDEX "{IncrementalSQL.INDEX_TABLE}_HASH" ON "{IncrementalSQL.INDEX_TABLE}" ("TABLENAME", "HASH");')
+        db.run(f'DELETE FROM "{IncrementalSQL.SCHEMA_TABLE}";')
+        db.run(f'INSERT INTO "{IncrementalSQL.SCHEMA_TABLE}" ("HASH") VALUES (\'{schema_hash}\');')
+        return False
+
+
+    @staticmethod
+    def load_ids(db: SQLGlobals):
+        # New rows continue after the highest ID of all tables sharing an ID name
+        for table in db.tables.values():
+            row = db.db.execute(f'SELECT MAX("{table.ref_name}") FROM "{table.tablename}"').fetchone()
+            if row[0]:
+                db.ids[table.ref_name] = max(db.ids.get(table.ref_name, 0), row[0])
+
+
+    @staticmethod
+    def delete_rows(db:       SQLGlobals,
+                    table:    SQLTable,
+                    children: dict,
+                    where:    str):
+        # Referencing tables first, their rows are found through the parent rows
+        for child in children.get(table.tablepath, []):
+            IncrementalSQL.delete_rows(db, child, children,
+                                       f'"REFERENCE_ID" IN (SELECT "{table.ref_name}" FROM "{table.tablename}" WHERE {where})')
+        db.run(f'DELETE FROM "{table.tablename}" WHERE {where};')
+
+
+    @staticmethod
+    def stream_checked_nodes(source: str,
+                             db:     SQLGlobals) -> dict:
+        # Inserts the records whose content hash is not in the index and deletes the
+        # rows of the indexed records that are gone. A changed record is deleted and
+        # inserted again with a new ID.
+        index = {}
+        cursor = db.db.execute(f'SELECT "TABLENAME", "HASH", "ID" FROM "{IncrementalSQL.INDEX_TABLE}"')
+        for tablename, record_hash, ref_id in cursor:
+            index.setdefault((tablename, record_hash), []).append(ref_id)
+
+        IncrementalSQL.load_ids(db)
+
+        stats = {'inserted': 0, 'unchanged': 0, 'deleted': 0}
+        for elem, name, subpath in InsertSQL.iter_checked_records(source, db):
+            table = db.tables[subpath]
+            key = (table.tablename, IncrementalSQL.get_record_hash(elem))
+            ids = index.get(key)
+            if ids:
+                ids.pop()
+                stats['unchanged'] += 1
+                continue
+
+            if db.progress:
+                db.progress.enter('build')
+            InsertSQL.insert_sql_table(elem, name, subpath, db)
+            db.insert_row(IncrementalSQL.INDEX_TABLE, IncrementalSQL.INDEX_TABLE,
+                          IncrementalSQL.INDEX_COLUMNS, [*key, db.ids[table.ref_name]])
+            if db.progress:
+                db.progress.leave('build')
+            stats['inserted'] += 1
+
+        db.flush()
+
+        deleted = [(tablename, ref_id) for (tablename, _), ids in index.items() for ref_id in ids]
+        stats['deleted'] = len(deleted)
+        if deleted:
+            db.run(f'CREATE TEMP TABLE IF NOT EXISTS "{IncrementalSQL.DELETE_TABLE}" ("TABLENAME" TEXT, "ID" INTEGER);')
+            db.run(f'DELETE FROM "{IncrementalSQL.DELETE_TABLE}";')
+            db.db.executemany(f'INSERT INTO "{IncrementalSQL.DELETE_TABLE}" VALUES (?, ?)', deleted)
+
+            children = {}
+            for table in db.tables.values():
+                if table.parent:
+                    children.setdefault(table.parent.tablepath, []).append(table)
+
+            for table in db.tables.values():
+                if not table.parent:
+                    IncrementalSQL.delete_rows(db, table, children,
+                                               f'"{table.ref_name}" IN (SELECT "ID" FROM "{IncrementalSQL.DELETE_TABLE}" '
+                                               f'WHERE "TABLENAME" = {SQLGlobals.get_sql_literal(table.tablename)})')
+
+            db.run(f'DELETE FROM "{IncrementalSQL.INDEX_TABLE}" WHERE ("TABLENAME", "ID") IN '
+                   f'(SELECT "TABLENAME", "ID" FROM "{IncrementalSQL.DELETE_TABLE}");')
+
+        print(f'Incremental import: {stats}')
+        return stats
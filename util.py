@@ -1,20 +1,39 @@
 import os
+import sys
+import uuid
+import hashlib
+import threading
+from functools import lru_cache
 from xml.etree import ElementTree
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
+from cacheutil import evict_files
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 
 CHILDREN = 'children'
 LABEL = 'label'
 VALUE = 'value'
 
 
+# Distinct (tag, parent path) pairs of a document, a catalog has a few hundred
+TAG_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
 def get_tag_name(tag:         str,
                  parent_path: str,
                  ignore_ns:   bool) -> {str, str}:
+    # Called for every element and attribute, the same few tags repeat millions of times.
+    # The strings are interned, so the analysis and the rows share a single copy of each.
     split = tag.split("}")
     name = split[1] if ignore_ns and len(split) > 1 else tag
     subpath = (parent_path + '/' if len(parent_path) > 0 else '') + name
-    return name, subpath
+    return sys.intern(name), sys.intern(subpath)
 
 
 def get_node_name(node:        ElementTree,
@@ -28,13 +47,170 @@ def prefix_field_name(field:     str,
     return prefix + field
 
 
-def save_temp_file(file: UploadedFile) -> str:
-    folder = 'tmp'
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    
-    file_path = f'./{folder}/{file.name}'
-    with open(file_path, 'wb') as f:
-        f.write(file.getvalue())
+class CountingReader:
+    count: int
+
+    # Binary reader that counts the bytes handed to the parser
+    def __init__(self, source):
+        self.owned = isinstance(source, str)
+        self.file = open(source, 'rb') if self.owned else source
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+    def get_size(self) -> int:
+        try:
+            return os.fstat(self.file.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            pass
+
+        # In-memory files like an UploadedFile have no descriptor
+        if not getattr(self.file, 'seekable', lambda: False)():
+            return 0
+        position = self.file.tell()
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(position)
+        return size
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+class XMLParser:
+    # Parser backend of all imports and analyses, set with XML_PARSER:
+    #   auto    lxml for the records filtered by tag, the stdlib for walks over every element
+    #   lxml    lxml everywhere
+    #   stdlib  the stdlib ElementTree everywhere, also the fallback without lxml
+    # lxml only pays off when it can skip events in C, a Python handler for every element
+    # is faster with the stdlib. Both build the same elements: comments and processing
+    # instructions are dropped like the stdlib does.
+    backend = os.getenv("XML_PARSER", "auto") if lxml_etree is not None else 'stdlib'
+
+    @staticmethod
+    def iterparse(source,
+                  events: tuple = ('start', 'end')):
+        if XMLParser.backend == 'lxml':
+            return lxml_etree.iterparse(source, events=events, huge_tree=True,
+                                        remove_comments=True, remove_pis=True)
+        return ElementTree.iterparse(source, events=events)
+
+    @staticmethod
+    def iter_records(source,
+                     tag:      str,
+                     elements: bool = False):
+        # Yields every element with the local name tag as soon as its end tag arrives, with
+        # the number of records so far. The records are freed after use, lxml skips all other
+        # events in C. With elements the number of elements parsed so far is counted instead,
+        # lxml then has to walk every record in Python, which costs much of its lead.
+        if XMLParser.backend != 'stdlib':
+            count = 0
+            for _, elem in lxml_etree.iterparse(source, events=('end',), tag='{*}' + tag, huge_tree=True,
+                                                remove_comments=True, remove_pis=True):
+                count += sum(1 for _ in elem.iter()) if elements else 1
+                yield elem, count
+                elem.clear()
+                # Drops the record and whatever was parsed before it on the same level
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+                    parent.remove(elem)
+            return
+
+        stack = []
+        count = 0
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                if elements:
+                    count += 1
+                continue
+
+            stack.pop()
+            if elem.tag.rsplit('}', 1)[-1] == tag:
+                if not elements:
+                    count += 1
+                yield elem, count
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+
+    @staticmethod
+    def fromstring(data: bytes) -> ElementTree:
+        if XMLParser.backend == 'lxml':
+            parser = lxml_etree.XMLParser(huge_tree=True, remove_comments=True, remove_pis=True)
+            return lxml_etree.fromstring(data, parser)
+        return ElementTree.fromstring(data)
+
+    @staticmethod
+    def tostring(node: ElementTree) -> bytes:
+        if XMLParser.backend == 'lxml':
+            return lxml_etree.tostring(node)
+        return ElementTree.tostring(node)
+
+
+# Uploads are spooled to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+UPLOAD_FOLDER = os.path.join('tmp', 'content')
+UPLOAD_SIZE = int(os.getenv("UPLOAD_SIZE", str(10 << 30)))
+UPLOAD_LOCK = threading.Lock()
+
+
+def iter_upload_chunks(file:       UploadedFile,
+                       chunk_size: int = UPLOAD_CHUNK_SIZE):
+    # An UploadedFile is a BytesIO, the slices of its buffer share the memory of the upload.
+    # The buffer is released afterwards, a BytesIO can't be changed while it is exported.
+    if not hasattr(file, 'getbuffer'):
+        file.seek(0)
+        while chunk := file.read(chunk_size):
+            yield chunk
+        return
+
+    with file.getbuffer() as view:
+        for start in range(0, len(view), chunk_size):
+            with view[start:start + chunk_size] as chunk:
+                yield chunk
+
+
+def get_upload_hash(file: UploadedFile) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter_upload_chunks(file):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_temp_file(file: UploadedFile,
+                   keep: set = None) -> {str, str}:
+    # Returns the path and the content hash of the upload. It is stored by its content, so a
+    # repeated upload of the same file is not written again and keeps its path. The least
+    # recently uploaded files are removed when the uploads together grow above UPLOAD_SIZE,
+    # except for this one and the files to keep, like the sources of running imports.
+    digest = get_upload_hash(file)
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    file_path = f'./{UPLOAD_FOLDER}/{digest}.xml'
+    try:
+        # The modification time orders the uploads for the eviction
+        os.utime(file_path)
+        return file_path, digest
+    except FileNotFoundError:
+        pass
+
+    # Written under a unique name and renamed, a concurrent upload never sees a partial file
+    part_path = f'{file_path}.{uuid.uuid4().hex}.part'
+    try:
+        with open(part_path, 'wb') as f:
+            for chunk in iter_upload_chunks(file):
+                f.write(chunk)
+        os.replace(part_path, file_path)
+    except:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
 
-    return file_path
+    with UPLOAD_LOCK:
+        evict_files([UPLOAD_FOLDER], '.xml', UPLOAD_SIZE, keep={file_path, *(keep or ())})
+    return file_path, digest
@@ -1,11 +1,28 @@
+import re
 from xml.etree import ElementTree
 
 from util import (
-  get_node_name, get_tag_name, prefix_field_name, CHILDREN, LABEL, VALUE
+  get_node_name, get_tag_name, prefix_field_name, CountingReader, XMLParser, CHILDREN, LABEL, VALUE
 )
 
 COUNT = 'count'
 LIST = 'list'
+TYPE = 'type'
+DISTINCT = 'distinct'
+DISTINCT_VALUES = '_distinct_values'
+CHILD_INDEX = '_child_index'
+
+INTEGER = 'INTEGER'
+REAL = 'REAL'
+TEXT = 'TEXT'
+
+# A column is only typed when every value reads back as the same text. '007', '-0', '-0.0', '1e5'
+# or '82.70' stay TEXT, and so does a column with integers and decimals, '1' would read back as 1.0.
+INTEGER_PATTERN = re.compile(r'-?(0|[1-9][0-9]{0,17})')
+REAL_PATTERN = re.compile(r'-?(0|[1-9][0-9]*)\.[0-9]+')
+
+# Distinct values are counted up to this limit, columns reaching it are high-cardinality
+DISTINCT_LIMIT = 1000
 
 
 class XML2TreeSelect:
@@ -13,68 +30,221 @@ class XML2TreeSelect:
     @staticmethod
     def add_child_node(target_node: dict,
                        name:        str,
-                       subpath:     str) -> dict:
-        if CHILDREN not in target_node:
+                       subpath:     str,
+                       count:       int = 1) -> dict:
+        # The children are looked up by name, the list keeps their order for tree_select
+        index = target_node.get(CHILD_INDEX)
+        if index is None:
+            index = target_node[CHILD_INDEX] = {}
             target_node[CHILDREN] = []
 
-        for child in target_node[CHILDREN]:
-            if child[LABEL] == name:
-                child[COUNT] += 1
-                return child
+        child = index.get(name)
+        if child is not None:
+            child[COUNT] += count
+            return child
 
-        child = {LABEL: name, VALUE: subpath, COUNT: 1, LIST:False}
+        child = {LABEL: name, VALUE: subpath, COUNT: count, LIST:False}
         target_node[CHILDREN].append(child)
+        index[name] = child
         return child
 
 
+    @staticmethod
+    def add_value(node:  dict,
+                  value: str):
+        value = None if value is None else value.strip()
+        if not value:
+            return
+
+        distinct = node.get(DISTINCT_VALUES)
+        if distinct is None:
+            distinct = node[DISTINCT_VALUES] = set()
+        if len(distinct) < DISTINCT_LIMIT:
+            distinct.add(hash(value))
+
+        column_type = node.get(TYPE)
+        if column_type == TEXT:
+            return
+        if INTEGER_PATTERN.fullmatch(value) and str(int(value)) == value:
+            value_type = INTEGER
+        elif REAL_PATTERN.fullmatch(value) and repr(float(value)) == value and value != '-0.0':
+            value_type = REAL
+        else:
+            value_type = TEXT
+        node[TYPE] = value_type if column_type in (None, value_type) else TEXT
+
+
     @staticmethod
     def recursive_analyse_xml(root:        ElementTree,
                               parent_path: str,
                               target_node: dict,
                               ignore_ns:   bool):
-
-        subpaths = []
-        for attrib in root.keys():
-            name, subpath = get_tag_name(attrib, parent_path, ignore_ns)
-            child = XML2TreeSelect.add_child_node(target_node, name, subpath)
-            if subpath in subpaths:
-                child[LIST] = True
-            else:
-                subpaths.append(subpath)
-
-        for node in root:
-            name, subpath = get_node_name(node, parent_path, ignore_ns)
-            child = XML2TreeSelect.add_child_node(target_node, name, subpath)
-            if subpath in subpaths:
-                child[LIST] = True
-            else:
-                subpaths.append(subpath)
-
-            XML2TreeSelect.recursive_analyse_xml(node, subpath, child, ignore_ns)
+        # Walks the elements in document order with an explicit stack, so the depth
+        # of the document is not limited by the recursion limit
+        stack = [(root, parent_path, target_node)]
+        while stack:
+            root, parent_path, target_node = stack.pop()
+
+            subpaths = set()
+            for attrib, text in root.items():
+                name, subpath = get_tag_name(attrib, parent_path, ignore_ns)
+                child = XML2TreeSelect.add_child_node(target_node, name, subpath)
+                XML2TreeSelect.add_value(child, text)
+                if subpath in subpaths:
+                    child[LIST] = True
+                else:
+                    subpaths.add(subpath)
+
+            pending = []
+            for node in root:
+                name, subpath = get_node_name(node, parent_path, ignore_ns)
+                child = XML2TreeSelect.add_child_node(target_node, name, subpath)
+                XML2TreeSelect.add_value(child, node.text)
+                if subpath in subpaths:
+                    child[LIST] = True
+                else:
+                    subpaths.add(subpath)
+
+                pending.append((node, subpath, child))
+
+            stack.extend(reversed(pending))
 
 
     @staticmethod
-    def recursive_add_count(node:    dict,
-                            checked: list):
-        count = node[COUNT]
-
-        if node[LIST]:
-            node[LABEL] += f': [{count}]'
-            checked.append(node[VALUE])
+    def stream_analyse_xml(source:       str,
+                           ignore_ns:    bool,
+                           max_records:  int = None,
+                           max_bytes:    int = None,
+                           sample_every: int = 1) -> {dict, float}:
+        # Walk the start/end events instead of a parsed tree. Only the open elements
+        # are kept, every finished element is cleared and dropped from its parent.
+        #
+        # For a sample only every sample_every-th repeated sibling is analysed and the
+        # counts below it are weighted, and the scan stops after max_records records
+        # (elements at the shallowest repeated level) or max_bytes. The returned factor
+        # extrapolates the counts to the whole file, it is None for a full analysis.
+        reader = CountingReader(source)
+        size = reader.get_size()
+        struct = None
+        stack = []
+        records = 0
+        record_depth = None
+        sampled = False
+        stopped = False
+        try:
+            for event, elem in XMLParser.iterparse(reader):
+                if event == 'start':
+                    weight = 1
+                    if stack:
+                        _, parent_node, parent_path, siblings, weight = stack[-1]
+                        if parent_node is None:
+                            # Inside a sibling that is not sampled
+                            stack.append((elem, None, None, None, 0))
+                            continue
+
+                        name, subpath = get_node_name(elem, parent_path, ignore_ns)
+                        node = XML2TreeSelect.add_child_node(parent_node, name, subpath, weight)
+                        seen = siblings.get(subpath, 0)
+                        siblings[subpath] = seen + 1
+                        if seen:
+                            node[LIST] = True
+                            if record_depth is None or len(stack) < record_depth:
+                                # The first of these records is already complete
+                                record_depth = len(stack)
+                                records = 1
+
+                            if sample_every > 1:
+                                sampled = True
+                                if (seen - 1) % sample_every:
+                                    stack.append((elem, None, None, None, 0))
+                                    continue
+                                weight *= sample_every
+                    else:
+                        name, subpath = get_node_name(elem, "", ignore_ns)
+                        node = struct = {LABEL: name, VALUE: subpath, COUNT: 1, LIST: False}
+
+                    subpaths = set()
+                    for attrib, text in elem.items():
+                        attrib_name, attrib_path = get_tag_name(attrib, subpath, ignore_ns)
+                        child = XML2TreeSelect.add_child_node(node, attrib_name, attrib_path, weight)
+                        XML2TreeSelect.add_value(child, text)
+                        if attrib_path in subpaths:
+                            child[LIST] = True
+                        else:
+                            subpaths.add(attrib_path)
+
+                    stack.append((elem, node, subpath, {}, weight))
+
+                else:
+                    # The text of an element is only complete at its end event
+                    node = stack.pop()[1]
+                    if node is not None:
+                        XML2TreeSelect.add_value(node, elem.text)
+                    elem.clear()
+                    if stack:
+                        stack[-1][0].remove(elem)
+
+                    if len(stack) == record_depth:
+                        records += 1
+                    if (max_records and records >= max_records) or (max_bytes and reader.count >= max_bytes):
+                        stopped = stack != []
+                        break
+        finally:
+            reader.close()
+
+        if stopped:
+            return struct, size / reader.count if size > reader.count else 1.0
+        return struct, 1.0 if sampled else None
 
-        elif count > 1:
-            node[LABEL] += f': ({count})'
 
-        if CHILDREN in node:
-            for child in node[CHILDREN]:
-                XML2TreeSelect.recursive_add_count(child, checked)
+    @staticmethod
+    def recursive_add_count(node:     dict,
+                            checked:  list,
+                            estimate: float = None):
+        # An estimated count is extrapolated by the given factor and marked with ~
+        mark = '' if estimate is None else '~'
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            count = node[COUNT]
+            if estimate is not None and count > 1:
+                count = node[COUNT] = round(count * estimate)
+
+            # The value set and child index are only needed during the analysis and can't be serialized
+            node.pop(CHILD_INDEX, None)
+            distinct = node.pop(DISTINCT_VALUES, None)
+            if distinct is not None:
+                node[DISTINCT] = len(distinct)
+
+            if node[LIST]:
+                node[LABEL] += f': [{mark}{count}]'
+                checked.append(node[VALUE])
+
+            elif count > 1:
+                node[LABEL] += f': ({mark}{count})'
+
+            if CHILDREN in node:
+                stack.extend(reversed(node[CHILDREN]))
 
     @staticmethod
     def convert(root:      ElementTree,
                 ignore_ns: bool) -> {dict, list}:
         name, subpath = get_node_name(root, "", ignore_ns)
         struct = {LABEL: name, VALUE: subpath, COUNT : 1, LIST:False}
+        XML2TreeSelect.add_value(struct, root.text)
         XML2TreeSelect.recursive_analyse_xml(root, name, struct, ignore_ns)
         checked = []
         XML2TreeSelect.recursive_add_count(struct, checked)
         return struct, checked
+
+    @staticmethod
+    def convert_file(source:       str,
+                     ignore_ns:    bool,
+                     max_records:  int = None,
+                     max_bytes:    int = None,
+                     sample_every: int = 1) -> {dict, list}:
+        struct, estimate = XML2TreeSelect.stream_analyse_xml(source, ignore_ns, max_records,
+                                                             max_bytes, sample_every)
+        checked = []
+        XML2TreeSelect.recursive_add_count(struct, checked, estimate)
+        return struct, checked